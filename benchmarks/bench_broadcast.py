@@ -0,0 +1,62 @@
+"""
+Cost of sending one message to N recipients, per recipient:
+serialization for each recipient (as send_msg did) against one frame shared by all queues.
+
+    python benchmarks/bench_broadcast.py [recipients]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from common.utils import encode_msg  # noqa: E402
+from common.variables import ACTION, TIME, FROM, TO, MESSAGE_TEXT, MESSAGE_GROUP  # noqa: E402
+from outbound_queue import OutboundQueue, SPILL  # noqa: E402
+
+MESSAGE = {
+    ACTION: MESSAGE_GROUP,
+    TIME: time.time(),
+    FROM: 'user_1',
+    TO: 'group',
+    MESSAGE_TEXT: 'Hello, group! ' * 20
+}
+
+
+def make_queues(count):
+    return [OutboundQueue(1 << 30, 1 << 29, SPILL) for _ in range(count)]
+
+
+def encode_per_recipient(queues, msg):
+    for queue in queues:
+        queue.put(encode_msg(msg))
+
+
+def encode_once(queues, msg):
+    frame = encode_msg(msg)
+    for queue in queues:
+        queue.put(frame)
+
+
+def measure(func, recipients, repeat=20):
+    best = None
+    for _ in range(repeat):
+        queues = make_queues(recipients)
+        start = time.perf_counter()
+        func(queues, MESSAGE)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / recipients
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 10000]
+    print(f'{"recipients":>10} {"per recipient":>16} {"encode once":>14} {"speedup":>8}')
+    for count in counts:
+        each = measure(encode_per_recipient, count)
+        once = measure(encode_once, count)
+        print(f'{count:>10} {each * 1e6:>13.2f} us {once * 1e6:>11.2f} us {each / once:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Encoding and decoding speed and the size on the wire of typical messages:
+JSON headers against the binary codec negotiated at PRESENCE.
+
+    python benchmarks/bench_codec.py [repeat]
+"""
+import os
+import sys
+import time
+import base64
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from common.utils import encode_msg, MessageDecoder  # noqa: E402
+from common.codec import JSON, BINARY  # noqa: E402
+from common.variables import (ACTION, TIME, USER, ACCOUNT_NAME, PUBLIC_KEY, FROM, TO, RESPONSE,  # noqa: E402
+                              LIST_INFO, DATA, PRESENCE, MESSAGE)
+
+AVATAR = os.urandom(30 * 1024)
+
+MESSAGES = {
+    'presence': {
+        ACTION: PRESENCE,
+        TIME: time.time(),
+        USER: {ACCOUNT_NAME: 'user_1', PUBLIC_KEY: '-----BEGIN PUBLIC KEY-----\n' + 'A' * 400}
+    },
+    'message': {ACTION: MESSAGE, TIME: time.time(), FROM: 'user_1', TO: 'user_2'},
+    'users list': {RESPONSE: 202, LIST_INFO: [f'user_{number}' for number in range(1000)]},
+}
+
+
+def avatar(codec):
+    # Bytes are written as they are by the binary codec, JSON needs base64
+    data = AVATAR if codec == BINARY else base64.b64encode(AVATAR).decode('ascii')
+    return {RESPONSE: 511, DATA: data}
+
+
+def measure(msg, codec, repeat):
+    frame = encode_msg(msg, codec=codec)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encode_msg(msg, codec=codec)
+    encode_time = (time.perf_counter() - start) / repeat
+
+    decoder = MessageDecoder()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decoder.feed(frame)
+        decoder.frames.popleft().message()
+    decode_time = (time.perf_counter() - start) / repeat
+    return len(frame), encode_time, decode_time
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f'{"message":>12} {"codec":>7} {"bytes":>8} {"encode":>12} {"decode":>12}')
+    cases = [(name, {JSON: msg, BINARY: msg}) for name, msg in MESSAGES.items()]
+    cases.append(('avatar', {JSON: avatar(JSON), BINARY: avatar(BINARY)}))
+    for name, messages in cases:
+        for codec in (JSON, BINARY):
+            size, encode_time, decode_time = measure(messages[codec], codec, repeat)
+            print(f'{name:>12} {codec:>7} {size:>8} {encode_time * 1e6:>9.2f} us {decode_time * 1e6:>9.2f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Encryption and decryption speed of personal messages:
+RSA blocks of older clients against RSA-wrapped AES-GCM session keys,
+and the cost of a group message: RSA for each member against one sender key.
+
+    python benchmarks/bench_encryption.py [repeat]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+from Cryptodome.PublicKey import RSA  # noqa: E402
+from encrypt_decrypt import EncryptDecrypt  # noqa: E402
+
+SIZES = (200, 4 * 1024, 64 * 1024)  # Characters of HTML text
+GROUP_SIZES = (10, 100)  # Members of a group
+
+
+def measure(function, argument, repeat):
+    result = function(argument)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(argument)
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    sender = EncryptDecrypt('sender', RSA.generate(EncryptDecrypt.KEY_SIZE))
+    recipient = EncryptDecrypt('recipient', RSA.generate(EncryptDecrypt.KEY_SIZE))
+    sender.create_current_encrypt(recipient.get_pubkey_user())
+    modes = (('rsa', sender.message_encryption_rsa), ('hybrid', sender.message_encryption))
+
+    print(f'{"chars":>7} {"mode":>7} {"bytes":>8} {"encrypt":>12} {"decrypt":>12}')
+    for size in SIZES:
+        text = ('<p>message</p>' * (size // 14 + 1))[:size]
+        for mode, encrypt in modes:
+            encrypted, encrypt_time = measure(encrypt, text, repeat)
+            decrypted, decrypt_time = measure(recipient.message_decryption, encrypted, repeat)
+            assert decrypted == text
+            print(f'{size:>7} {mode:>7} {len(encrypted):>8} {size / encrypt_time / 1e6:>7.2f} MB/s '
+                  f'{size / decrypt_time / 1e6:>7.2f} MB/s')
+
+    # The session key of a new sender is decrypted with RSA once, then it is taken from memory
+    text = '<p>message</p>'
+    recipient.received_keys.clear()
+    encrypted = sender.message_encryption(text)
+    start = time.perf_counter()
+    recipient.message_decryption(encrypted)
+    first_time = time.perf_counter() - start
+    _, next_time = measure(recipient.message_decryption, encrypted, repeat)
+    print(f'short message decrypt: new session key {first_time * 1e3:.2f} ms, known key {next_time * 1e3:.3f} ms')
+
+    # A group message encrypted for each member with RSA against once with the key of the sender,
+    # the key itself is encrypted with RSA for each member only when the members change
+    public_key = recipient.get_pubkey_user()
+    key_id, group_key = sender.new_group_key()
+    for members in GROUP_SIZES:
+        logins = [f'member_{number}' for number in range(members)]
+        _, wrap_time = measure(lambda key: [sender.wrap_group_key(key, public_key) for login in logins],
+                               group_key, 1)
+        _, group_time = measure(lambda message: sender.group_encryption(key_id, group_key, message), text, repeat)
+        print(f'group of {members:>3}: RSA for each member {wrap_time * 1e3:.2f} ms, '
+              f'sender key {group_time * 1e3:.3f} ms per message')
+
+
+if __name__ == '__main__':
+    main()
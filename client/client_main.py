@@ -1,39 +1,49 @@
 import sys
 import time
+import random
 import socket
 import logging
 import argparse
 import threading
+import selectors
 import hashlib
 import hmac
 import binascii
 import json
 import base64
+from functools import partial
 from database.mongo_db_client import MongoDbClient
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtCore import pyqtSignal, QObject
-from common.utils import get_msg, send_msg
+from common.utils import (get_msg, send_msg, get_decoder, set_codec, get_codec, set_compression, get_compressor,
+                          loggable)
+from common.codec import JSON, BINARY, CODECS
 from common.variables import (DEFAULT_IP_ADDRESS, DEFAULT_PORT, TO, USER, ACCOUNT_NAME,
                               RESPONSE_511, ERROR, DATA, RESPONSE, TIME, PRESENCE, FROM,
                               EXIT, GET_CONTACTS, PUBLIC_KEY, ACTION, MESSAGE_TEXT, MESSAGE,
                               LIST_INFO, ADD_CONTACT, DELETE_CONTACT, USERS_REQUEST,
-                              PUBLIC_KEY_REQUEST, SEND_AVATAR, IMAGE, GET_AVATAR,
-                              GET_GROUPS, get_path, GET_MESSAGES_GROUPS, MESSAGE_GROUP)
+                              PUBLIC_KEY_REQUEST, KEYS_REQUEST, SEND_AVATAR, IMAGE, GET_AVATAR,
+                              GET_GROUPS, get_path, GET_MESSAGES_GROUPS, MESSAGE_GROUP,
+                              KDF, KDF_ALGORITHM, KDF_ITERATIONS, USERS_VERSION, VERSION, ADDED, REMOVED,
+                              BEFORE, AFTER, LIMIT, MESSAGES_PAGE_LIMIT, KEY_ID,
+                              JOIN, LEAVE, ROOM, CODEC, COMPRESSION, ZLIB, REQUEST_ID, TICKET,
+                              RECONNECT_ATTEMPTS, RECONNECT_DELAY, REQUEST_TIMEOUT)
 from common.errors import (IncorrectDataNotDictError, FieldMissingError,
-                           IncorrectCodeError, ServerError)
+                           IncorrectCodeError, ServerError, IncorrectFrameLengthError)
 from common.decos import Logging
 from common.descriptors import CheckPort, CheckIP, CheckName
-from database.database_client import ClientDB
+from database.database_client import ClientDB, USERS, CONTACTS, GROUPS, MESSAGES_GROUPS, KEYS
 from gui_client.gui_start_dialog import UserNameDialog
 from gui_client.gui_main_window import ClientMainWindow
 from gui_client.gui_loading_dialog import LoadingWindow
 from encrypt_decrypt import EncryptDecrypt
+from pending_requests import PendingRequests
+from group_keys import GroupKeys, UNREADABLE_MESSAGE
 import logs.client_log_config
 
 LOGGER = logging.getLogger('client')
 
 LOCK_DATABASE = threading.Lock()
-LOCK_SOCKET = threading.Lock()
 
 
 @Logging()
@@ -43,12 +53,15 @@ def get_args():
     parser.add_argument('-port', default=DEFAULT_PORT, type=int, nargs='?')
     parser.add_argument('-n', '--name', default=None, nargs='?')
     parser.add_argument('-p', '--password', default=None, nargs='?')
+    parser.add_argument('-z', '--compress', action='store_true', help='compress traffic if the server supports it')
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help='binary message headers if the server supports them')
     namespace = parser.parse_args(sys.argv[1:])
     server_ip = namespace.ip
     server_port = namespace.port
     login_client = namespace.name
     password_client = namespace.password
-    return server_ip, server_port, login_client, password_client
+    return server_ip, server_port, login_client, password_client, namespace.compress, namespace.binary
 
 
 class Client(threading.Thread, QObject):
@@ -69,7 +82,8 @@ class Client(threading.Thread, QObject):
     new_group_signal = pyqtSignal()
 
     def __init__(self, connection, server_ip, server_port, client_login,
-                 client_password, database, mongo_db, encrypt_decrypt):
+                 client_password, database, mongo_db, encrypt_decrypt, pending_requests, group_keys,
+                 compression=False, binary=False):
         self.server_ip = server_ip
         self.server_port = server_port
         self.client_login = client_login
@@ -77,10 +91,19 @@ class Client(threading.Thread, QObject):
         self.database = database
         self.mongo_db = mongo_db
         self.connection = connection
+        self.pending_requests = pending_requests
         self.encrypt_decrypt = encrypt_decrypt
-        self.pubkey = encrypt_decrypt.get_pubkey_user()
+        self.group_keys = group_keys
+        self.compression = compression  # Ask the server to compress the connection
+        # Offer the binary header codec. It makes frames smaller, JSON is decoded faster for the common headers.
+        self.binary = binary
 
         self.is_connected = False
+        # Wakes up the receive loop when the client is closed
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.stopped = False  # The client is closed, the connection is not restored
+        self.users_version = None  # Version of the user directory received from the server
+        self.ticket = None  # The server logs the client in again with it after the connection is lost
 
         threading.Thread.__init__(self)
         QObject.__init__(self)
@@ -115,28 +138,20 @@ class Client(threading.Thread, QObject):
 
         self.start_authorization_procedure()
 
-        self.load_database()
+        # From now on everything the server sends is read by one thread,
+        # answers are passed to the requests waiting for them.
+        # The thread sleeps until data arrives, the socket does not need a timeout.
+        self.connection.settimeout(None)
+        reader = threading.Thread(target=self.get_message_from_server)
+        reader.daemon = True
+        reader.start()
 
-        self.get_message_from_server()
+        self.load_database()
 
     @Logging()
     def start_authorization_procedure(self):
-        pubkey = self.pubkey.decode('ascii')
-        msg_to_server = self.create_presence_msg(self.client_login, pubkey)
-
-        LOGGER.info(f'A message has been generated to the server - {msg_to_server}.')
         try:
-            send_msg(self.connection, msg_to_server)
-            LOGGER.debug(f'Message sent to server.')
-
-            answer_all = get_msg(self.connection)
-            answer_code = self.answer_server_presence(answer_all)
-            LOGGER.info(f'Received response from server - {answer_code}.\n')
-
-            self.send_hash_password(answer_all)
-
-            answer_code = self.answer_server_presence(get_msg(self.connection))
-
+            answer_code = self.authorize(self.connection)
         except json.JSONDecodeError:
             LOGGER.error('Failed to decode received Json string.')
             self.connection_lack()
@@ -162,25 +177,55 @@ class Client(threading.Thread, QObject):
             print(f'Server connection established.')
             self.progressbar_signal.emit()
 
+    def authorize(self, connection):
+        """
+        Log in on the connection. The password is checked with the challenge of the server (511),
+        a client with a valid ticket is logged in at once. Returns the code of the last answer.
+        """
+        # Keys are generated in the background while connecting, PRESENCE waits for them
+        pubkey = self.encrypt_decrypt.get_pubkey_user().decode('ascii')
+        msg_to_server = self.create_presence_msg(self.client_login, pubkey)
+
+        LOGGER.info(f'A message has been generated to the server - {loggable(msg_to_server)}.')
+        send_msg(connection, msg_to_server)
+        LOGGER.debug(f'Message sent to server.')
+
+        answer_all = get_msg(connection)
+        answer_code = self.answer_server_presence(answer_all)
+        LOGGER.info(f'Received response from server - {answer_code}.\n')
+        # Headers are sent in the codec chosen by the server, older servers answer without it
+        set_codec(connection, answer_all.get(CODEC, JSON))
+        if answer_all.get(COMPRESSION) == ZLIB:
+            set_compression(connection)
+
+        if answer_all[RESPONSE] == 511:
+            self.send_hash_password(connection, answer_all)
+            answer_all = get_msg(connection)
+            answer_code = self.answer_server_presence(answer_all)
+        self.ticket = answer_all.get(TICKET)
+        return answer_code
+
     @Logging()
-    def get_hash_password(self):
+    def get_hash_password(self, algorithm=KDF_ALGORITHM, iterations=KDF_ITERATIONS):
         password_bytes = self.client_password.encode('utf-8')
         salt = self.client_login.lower().encode('utf-8')
-        password_hash = hashlib.pbkdf2_hmac('sha512', password_bytes, salt, 10000)
+        password_hash = hashlib.pbkdf2_hmac(algorithm, password_bytes, salt, iterations)
         password_hash_string = binascii.hexlify(password_hash)
         return password_hash_string
 
     @Logging()
-    def send_hash_password(self, answer_all):
+    def send_hash_password(self, connection, answer_all):
         answer_data = answer_all[DATA]
-        password_hash_string = self.get_hash_password()
+        # Parameters of the hash stored on the server, older servers do not send them
+        algorithm, iterations = answer_all.get(KDF, (KDF_ALGORITHM, KDF_ITERATIONS))
+        password_hash_string = self.get_hash_password(algorithm, iterations)
 
-        hash = hmac.new(password_hash_string, answer_data.encode('utf-8'))
+        hash = hmac.new(password_hash_string, answer_data.encode('utf-8'), 'md5')
         digest = hash.digest()
         my_answer = RESPONSE_511
         my_answer[DATA] = binascii.b2a_base64(digest).decode('ascii')
 
-        send_msg(self.connection, my_answer)
+        send_msg(connection, my_answer)
 
     @Logging()
     def connection_lack(self):
@@ -188,49 +233,128 @@ class Client(threading.Thread, QObject):
         self.connection_lack_signal.emit()
         exit(1)
 
+    def sync_steps(self):
+        # Each request carries the last version saved in the database, only changes since then are received
+        return (
+            (self.create_users_request(), self.save_users_all,
+             'List of known users updated successfully.', 'Error requesting list of known users.'),
+            (self.create_contacts_request(), self.save_contacts,
+             'Contact list updated successfully.', 'Contact list request error.'),
+            (self.create_groups_request(), self.save_groups,
+             'Group list updated successfully.', 'Group list request error.'),
+            (self.create_messages_groups_request(), self.save_messages_groups,
+             'Group messages updated successfully.', 'Group messages request error.'),
+            (self.create_keys_request(), self.save_keys,
+             'Public keys checked successfully.', 'Public keys request error.'),
+        )
+
     @Logging()
     def load_database(self):
+        # All requests are sent at once and each answer is written to the database
+        # while the next ones are still on the way: one round trip instead of four.
+        steps = self.sync_steps()
         try:
-            users_all = self.get_users_all()
-        except (ConnectionResetError, ServerError):
-            LOGGER.error('Error requesting list of known users.')
-            self.connection_lack()
-        else:
-            with LOCK_DATABASE:
-                self.database.add_known_users(users_all)
-                self.mongo_db.add_known_users(users_all)
-            print('List of known users updated successfully.')
-            self.progressbar_signal.emit()
-        try:
-            contacts_list = self.get_contacts_all()
-        except (ConnectionResetError, ServerError):
-            LOGGER.error('Contact list request error.')
-            self.connection_lack()
-        else:
-            with LOCK_DATABASE:
-                self.database.add_contacts(contacts_list)
-            print('Contact list updated successfully.')
-            self.progressbar_signal.emit()
-        try:
-            groups_list = self.get_groups()
-        except (ConnectionResetError, ServerError):
-            LOGGER.error('Contact list request error.')
+            futures = [self.pending_requests.send(request) for request, *_ in steps]
+        except OSError:
+            LOGGER.error('Error sending synchronization requests.')
             self.connection_lack()
-        else:
-            with LOCK_DATABASE:
-                self.database.add_groups(groups_list)
-            print('Contact list updated successfully.')
-            self.progressbar_signal.emit()
+        for future, (request, save, success_text, error_text) in zip(futures, steps):
+            try:
+                answer = self._answer(self.pending_requests.result(future))
+            except (OSError, ServerError):
+                LOGGER.error(error_text)
+                self.connection_lack()
+            else:
+                save(answer)
+                print(success_text)
+                self.progressbar_signal.emit()
+
+    @Logging()
+    def resync(self):
+        # Changes missed while the connection was lost, the client keeps working if they fail
+        steps = self.sync_steps()
         try:
-            messages_groups_list = self.get_messages_groups()
-        except (ConnectionResetError, ServerError):
-            LOGGER.error('Contact list request error.')
-            self.connection_lack()
-        else:
+            futures = [self.pending_requests.send(request) for request, *_ in steps]
+            for future, (request, save, success_text, error_text) in zip(futures, steps):
+                save(self._answer(self.pending_requests.result(future)))
+        except (OSError, ServerError) as error:
+            LOGGER.error(f'Synchronization after the connection was restored failed: {error}')
+
+    def save_users_all(self, answer):
+        # The whole list or the changes since the version of the request
+        with LOCK_DATABASE:
+            if LIST_INFO in answer:
+                self.database.add_known_users(answer[LIST_INFO])
+                self.mongo_db.add_known_users(answer[LIST_INFO])
+            else:
+                self.database.update_known_users(answer[ADDED], answer[REMOVED])
+                self.mongo_db.update_known_users(answer[ADDED], answer[REMOVED])
+            self.users_version = self.save_version(USERS, answer)
+
+    def save_contacts(self, answer):
+        with LOCK_DATABASE:
+            if LIST_INFO in answer:
+                self.database.add_contacts(answer[LIST_INFO])
+            else:
+                self.database.update_contacts(answer[ADDED], answer[REMOVED])
+            self.save_version(CONTACTS, answer)
+
+    def save_groups(self, answer):
+        with LOCK_DATABASE:
+            if LIST_INFO in answer:
+                self.database.add_groups(answer[LIST_INFO])
+            else:
+                self.database.update_groups(answer[ADDED], answer[REMOVED])
+            self.save_version(GROUPS, answer)
+
+    def save_messages_groups(self, answer):
+        # Messages missed since the last session come in pages, without a version only the version is received,
+        # the history of a group is requested by pages when the group is opened
+        while True:
+            messages = self.group_keys.decrypt_messages(answer[LIST_INFO])
             with LOCK_DATABASE:
-                self.database.add_messages_groups(messages_groups_list)
-            print('Contact list updated successfully.')
-            self.progressbar_signal.emit()
+                # Only the whole history sent by older servers replaces the saved messages
+                replace = not self.database.get_version(MESSAGES_GROUPS) and bool(messages)
+                self.database.add_messages_groups(messages, replace=replace)
+                self.save_version(MESSAGES_GROUPS, answer)
+            if len(answer[LIST_INFO]) < MESSAGES_PAGE_LIMIT:
+                return
+            answer = self._request(self.create_messages_groups_request())
+
+    def save_keys(self, answer):
+        # Saved keys of users that have logged in with new keys are dropped
+        with LOCK_DATABASE:
+            if LIST_INFO in answer:
+                self.database.del_public_keys()
+            else:
+                self.database.del_public_keys(answer[ADDED])
+            self.save_version(KEYS, answer)
+        for login in answer.get(ADDED, ()):
+            self.encrypt_decrypt.forget(login)
+
+    def key_changed(self, message):
+        with LOCK_DATABASE:
+            self.database.del_public_keys([message[ACCOUNT_NAME]])
+            # Missed notices are received with the next synchronization
+            if message[VERSION] == self.database.get_version(KEYS) + 1:
+                self.database.set_version(KEYS, message[VERSION])
+        self.encrypt_decrypt.forget(message[ACCOUNT_NAME])
+
+    def save_version(self, collection, answer):
+        # Older servers have no versions, everything is requested again next time
+        version = answer.get(VERSION, 0)
+        self.database.set_version(collection, version)
+        return version
+
+    def sync_request(self, action, collection, name_key=USER):
+        with LOCK_DATABASE:
+            version = self.database.get_version(collection)
+        return {
+            ACTION: action,
+            TIME: time.time(),
+            name_key: self.client_login,
+            VERSION: version
+        }
 
     @Logging()
     def create_presence_msg(self, account_name, pubkey):
@@ -240,64 +364,77 @@ class Client(threading.Thread, QObject):
             USER: {
                 ACCOUNT_NAME: account_name,
                 PUBLIC_KEY: pubkey
-            }
+            },
+            CODEC: list(CODECS) if self.binary else [JSON]
         }
+        if self.compression:
+            msg[COMPRESSION] = [ZLIB]
+        if self.ticket:
+            msg[TICKET] = self.ticket
         return msg
 
     @Logging()
-    def _get_info(self, request):
+    def _request(self, request):
         LOGGER.debug(f'Formed request {request}')
-        with LOCK_SOCKET:
-            send_msg(self.connection, request)
-            answer = get_msg(self.connection)
+        return self._answer(self.pending_requests.request(request))
+
+    @staticmethod
+    def _answer(answer):
         if RESPONSE in answer and answer[RESPONSE] == 202:
-            return answer[LIST_INFO]
+            return answer
         else:
             raise ServerError('Invalid server response.')
 
-    @Logging()
-    def get_users_all(self):
-        LOGGER.debug(f'Request a list of known users {self.client_login}')
-        request = {
-            ACTION: USERS_REQUEST,
-            TIME: time.time(),
-            ACCOUNT_NAME: self.client_login
-        }
-        return self._get_info(request)
+    def create_users_request(self):
+        return self.sync_request(USERS_REQUEST, USERS, ACCOUNT_NAME)
 
     @Logging()
-    def get_contacts_all(self):
-        LOGGER.debug(f'Request contact sheet for user {self.client_login}.')
-        request = {
-            ACTION: GET_CONTACTS,
-            TIME: time.time(),
-            USER: self.client_login
-        }
-        return self._get_info(request)
+    def update_known_users(self, message):
+        """Apply the change of the user directory, returns False if previous changes were missed."""
+        if LIST_INFO in message:
+            # Older servers send the whole list
+            users_all = message[LIST_INFO]
+            with LOCK_DATABASE:
+                self.database.add_known_users(users_all)
+                self.mongo_db.add_known_users(users_all)
+            return True
+        version = message[USERS_VERSION]
+        if self.users_version is not None and version > self.users_version + 1:
+            LOGGER.info(f'Missed changes of the user directory {self.users_version + 1}-{version - 1}.')
+            return False
+        with LOCK_DATABASE:
+            self.database.update_known_users(message[ADDED], message[REMOVED])
+            self.mongo_db.update_known_users(message[ADDED], message[REMOVED])
+            if version > (self.users_version or 0):
+                self.users_version = version
+                self.database.set_version(USERS, version)
+        return True
 
     @Logging()
-    def get_groups(self):
-        LOGGER.debug(f'Request groups for {self.client_login}.')
-        request = {
-            ACTION: GET_GROUPS,
-            TIME: time.time(),
-            USER: self.client_login
-        }
-        return self._get_info(request)
+    def resync_users(self):
+        # Only the missed changes are requested
+        LOGGER.debug(f'Request changes of known users {self.client_login}')
+        try:
+            answer = self._request(self.create_users_request())
+        except (OSError, ServerError):
+            LOGGER.error('Error requesting list of known users.')
+        else:
+            self.save_users_all(answer)
 
-    @Logging()
-    def get_messages_groups(self):
-        LOGGER.debug(f'Request messages groups for.')
-        request = {
-            ACTION: GET_MESSAGES_GROUPS,
-            TIME: time.time(),
-            USER: self.client_login
-        }
-        return self._get_info(request)
+    def create_contacts_request(self):
+        return self.sync_request(GET_CONTACTS, CONTACTS)
+
+    def create_groups_request(self):
+        return self.sync_request(GET_GROUPS, GROUPS)
+
+    def create_messages_groups_request(self):
+        return self.sync_request(GET_MESSAGES_GROUPS, MESSAGES_GROUPS)
+
+    def create_keys_request(self):
+        return self.sync_request(KEYS_REQUEST, KEYS)
 
-    @Logging()
     def answer_server_presence(self, msg):
-        LOGGER.debug(f'Parsing a message from the server - {msg}')
+        LOGGER.debug(f'Parsing a message from the server - {loggable(msg)}')
         if RESPONSE in msg:
             if msg[RESPONSE] == 511:
                 return 'OK: 511'
@@ -312,75 +449,174 @@ class Client(threading.Thread, QObject):
 
     @Logging()
     def get_message_from_server(self):
-        while True:
-            time.sleep(1)
-            with LOCK_SOCKET:
-                try:
-                    message = get_msg(self.connection)
-                except IncorrectDataNotDictError:
-                    LOGGER.error(f'Failed to decode received message.')
-                # Connection timed out if errno = None, otherwise connection break.
-                except OSError as err:
-                    # print(err.errno)
-                    if err.errno:
-                        if err.errno != 10038:
-                            LOGGER.critical(f'Lost server connection.')
-                            self.connection_lost_signal.emit()
-                            break
-                        else:
-                            break
-                except (ConnectionError, ConnectionAbortedError, ConnectionResetError,
-                        json.JSONDecodeError):
-                    LOGGER.critical(f'Lost server connection.')
+        # After a lost connection the client connects again, the changes made meanwhile are requested
+        while self.read_connection() and not self.stopped:
+            if not self.reconnect():
+                if not self.stopped:
                     self.connection_lost_signal.emit()
+                return
+            resync = threading.Thread(target=self.resync)
+            resync.daemon = True
+            resync.start()
+
+    def read_connection(self):
+        """Handle everything the server sends, returns True if the connection is lost, False if it is closed."""
+        # Wait until the socket is readable, everything received is handled at once
+        selector = selectors.DefaultSelector()
+        selector.register(self.connection, selectors.EVENT_READ)
+        selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        decoder = get_decoder(self.connection)  # May already hold frames read during authorization
+        try:
+            while self.receive_frames(decoder):
+                events = selector.select()
+                if any(key.fileobj is self.wakeup_reader for key, mask in events):
+                    return False
+                try:
+                    decoder.read_from(self.connection)
+                except (OSError, IncorrectFrameLengthError):
                     break
-                else:
-                    if ACTION in message and message[ACTION] == MESSAGE \
-                            and TO in message and FROM in message \
-                            and MESSAGE_TEXT in message and message[TO] == self.client_login:
-
-                        user_login = message[FROM]
-                        decrypted_message = self.encrypt_decrypt.message_decryption(message[MESSAGE_TEXT])
-
-                        LOGGER.info(f'Received message from user {user_login}:\n{decrypted_message}.')
-                        self.database.save_message(user_login, 'in', decrypted_message)
-                        self.new_message_signal.emit(user_login)
-
-                    elif ACTION in message and message[ACTION] == MESSAGE_GROUP \
-                            and TO in message and FROM in message \
-                            and MESSAGE_TEXT in message:
-                        with LOCK_DATABASE:
-                            self.database.add_group_message(message[TO], message[FROM], message[MESSAGE_TEXT])
-                        self.new_message_group_signal.emit(message[TO])
-
-                    elif RESPONSE in message and message[RESPONSE] == 205:
-                        with LOCK_DATABASE:
-                            self.database.add_known_users(message[LIST_INFO])
-                            self.mongo_db.add_known_users(message[LIST_INFO])
-
-                    elif RESPONSE in message and message[RESPONSE] == 206:
-                        with LOCK_DATABASE:
-                            self.database.add_groups(message[LIST_INFO])
-                            self.new_group_signal.emit()
-                    else:
-                        LOGGER.error(f'Invalid message received from server: {message}')
+            LOGGER.critical(f'Lost server connection.')
+            return True
+        finally:
+            selector.close()
+            self.pending_requests.fail_all(ConnectionResetError('Lost server connection.'))
+
+    @Logging()
+    def reconnect(self):
+        """
+        Connect to the server again, True if the client is logged in. With the ticket it takes
+        one round trip. The waits are random, so that the clients of a network failure
+        do not all connect at the same moment.
+        """
+        for attempt in range(RECONNECT_ATTEMPTS):
+            time.sleep(random.uniform(0, RECONNECT_DELAY * 2 ** attempt))
+            if self.stopped:
+                return False
+            connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                connection.settimeout(REQUEST_TIMEOUT)
+                connection.connect((self.server_ip, self.server_port))
+                self.authorize(connection)
+            except (OSError, ServerError, IncorrectDataNotDictError, IncorrectCodeError, FieldMissingError,
+                    IncorrectFrameLengthError, json.JSONDecodeError) as error:
+                LOGGER.info(f'Connection attempt {attempt + 1} failed: {error}')
+                connection.close()
+                continue
+            connection.settimeout(None)
+            self.connection.close()
+            self.connection = self.pending_requests.connection = connection
+            LOGGER.info('Server connection restored.')
+            return True
+        return False
+
+    def receive_frames(self, decoder):
+        """Handle the received frames, returns False if the connection is broken."""
+        while decoder.frames:
+            frame = decoder.frames.popleft()
+            try:
+                message = frame.message()
+            except (IncorrectDataNotDictError, UnicodeDecodeError):
+                LOGGER.error(f'Failed to decode received message.')
+            except json.JSONDecodeError:
+                return False
+            else:
+                self.process_server_message(message, frame)
+        return True
+
+    def save_group_message(self, message, text):
+        with LOCK_DATABASE:
+            self.database.add_group_message(message[TO], message[FROM], text, message.get(VERSION))
+        self.new_message_group_signal.emit(message[TO])
+
+    def fetch_group_message(self, message):
+        # The key of the message has not been pushed, it is requested from the server
+        self.group_keys.fetch(message[TO])
+        text = self.group_keys.decrypt(message[TO], message[FROM], message[MESSAGE_TEXT])
+        self.save_group_message(message, UNREADABLE_MESSAGE if text is None else text)
+
+    def stop_receiving(self):
+        self.stopped = True
+        self.wakeup_writer.send(b'\0')
+
+    def process_server_message(self, message, frame):
+        # Forwarded messages of other users keep the request id of the sender, answers have a response code
+        if RESPONSE in message and REQUEST_ID in message:
+            if not self.pending_requests.resolve(message):
+                LOGGER.warning(f'Answer to a request that is no longer waited for: {message}')
+
+        elif ACTION in message and message[ACTION] == MESSAGE \
+                and TO in message and FROM in message \
+                and message[TO] == self.client_login:
+
+            user_login = message[FROM]
+            # The encrypted text is the payload of the frame
+            decrypted_message = self.encrypt_decrypt.message_decryption(frame.payload)
+
+            LOGGER.info(f'Received message from user {user_login}:\n{decrypted_message}.')
+            self.database.save_message(user_login, 'in', decrypted_message)
+            self.new_message_signal.emit(user_login)
+
+        elif ACTION in message and message[ACTION] == MESSAGE_GROUP \
+                and TO in message and FROM in message \
+                and MESSAGE_TEXT in message:
+            text = self.group_keys.decrypt(message[TO], message[FROM], message[MESSAGE_TEXT])
+            if text is None:
+                # The reader thread cannot wait for the key that it has to read itself
+                fetch = threading.Thread(target=self.fetch_group_message, args=(message,))
+                fetch.daemon = True
+                fetch.start()
+            else:
+                self.save_group_message(message, text)
+
+        elif RESPONSE in message and message[RESPONSE] == 208:
+            self.group_keys.save_pushed(message[ROOM], message[FROM], message[KEY_ID], message[DATA])
+
+        elif RESPONSE in message and message[RESPONSE] == 205:
+            if not self.update_known_users(message):
+                # The reader thread cannot wait for the answer that it has to read itself
+                resync = threading.Thread(target=self.resync_users)
+                resync.daemon = True
+                resync.start()
+
+        elif RESPONSE in message and message[RESPONSE] == 207:
+            self.key_changed(message)
+
+        elif RESPONSE in message and message[RESPONSE] == 206:
+            with LOCK_DATABASE:
+                self.database.add_groups(message[LIST_INFO])
+                self.new_group_signal.emit()
+        else:
+            LOGGER.error(f'Invalid message received from server: {message}')
 
 
 class ClientTransport:
     """Functions for interacting with the server."""
-    def __init__(self, connection, client_login, database, encrypt_decrypt):
-        self.connection = connection
+    def __init__(self, client_login, database, encrypt_decrypt, pending_requests, group_keys):
+        self.pending_requests = pending_requests
         self.client_login = client_login
         self.database = database
         self.encrypt_decrypt = encrypt_decrypt
+        self.group_keys = group_keys
+        self.joined_groups = set()  # Groups joined in this session
+
+    @property
+    def connection(self):
+        # The connection is replaced when the client connects again
+        return self.pending_requests.connection
 
     @Logging()
     def is_received_pubkey(self, login):
-        current_chat_key = self.pubkey_request(login)
-        if current_chat_key:
-            self.encrypt_decrypt.create_current_encrypt(current_chat_key)
-            return True
-        return False
+        # The saved key is used until the server reports a new one
+        with LOCK_DATABASE:
+            current_chat_key = self.database.get_public_key(login)
+        if not current_chat_key:
+            current_chat_key = self.pubkey_request(login)
+            if not current_chat_key:
+                return False
+            with LOCK_DATABASE:
+                self.database.save_public_key(login, current_chat_key)
+        self.encrypt_decrypt.create_current_encrypt(current_chat_key, login)
+        return True
 
     @Logging()
     def pubkey_request(self, login):
@@ -391,13 +627,10 @@ class ClientTransport:
             TIME: time.time(),
             ACCOUNT_NAME: login
         }
-        with LOCK_SOCKET:
-            try:
-                send_msg(self.connection, request)
-                answer = get_msg(self.connection)
-            except (OSError, json.JSONDecodeError):
-                # self.connection_lost_signal.emit()
-                return
+        try:
+            answer = self.pending_requests.request(request)
+        except OSError:
+            return
         if RESPONSE in answer and answer[RESPONSE] == 511:
             LOGGER.debug(f'Loaded public key for {login}')
             return answer[DATA]
@@ -405,6 +638,70 @@ class ClientTransport:
             LOGGER.error(f'Failed to get the key of the interlocutor {login}. '
                          f'Answer server {answer}')
 
+    @Logging()
+    def pubkeys_request(self, logins):
+        """Public keys {login: key} of many users in one request."""
+        return self._batch_request(PUBLIC_KEY_REQUEST, logins)
+
+    @Logging()
+    def avatar_hashes_request(self, logins):
+        """SHA-256 {login: hash} of the avatars of many users in one request."""
+        return self._batch_request(GET_AVATAR, logins)
+
+    def _batch_request(self, action, logins):
+        request = {
+            ACTION: action,
+            TIME: time.time(),
+            LIST_INFO: list(logins)
+        }
+        try:
+            answer = self.pending_requests.request(request)
+        except OSError:
+            return {}
+        if RESPONSE in answer and answer[RESPONSE] == 202:
+            return answer[DATA]
+        LOGGER.error(f'Failed to get {action} for {len(logins)} users. Answer server {answer}')
+        return {}
+
+    def start_prefetch(self):
+        prefetch = threading.Thread(target=self.prefetch)
+        prefetch.daemon = True
+        prefetch.start()
+
+    @Logging()
+    def prefetch(self, logins=None):
+        """
+        Fill the saved keys and avatars of the contacts in the background after login,
+        so that chats are opened without requests to the server.
+        """
+        if logins is None:
+            with LOCK_DATABASE:
+                logins = self.database.get_contacts()
+        if not logins:
+            return
+        with LOCK_DATABASE:
+            public_keys = self.database.get_public_keys(logins)
+        missing = [login for login in logins if login not in public_keys]
+        if missing:
+            received_keys = self.pubkeys_request(missing)
+            with LOCK_DATABASE:
+                self.database.save_public_keys(received_keys)
+            public_keys.update(received_keys)
+        for login, public_key in public_keys.items():
+            self.encrypt_decrypt.prepare_encrypt(public_key, login)
+
+        for login, avatar_hash in self.avatar_hashes_request(logins).items():
+            if avatar_hash != self.file_hash(get_path(login)):
+                self.avatar_request(login)
+
+    @staticmethod
+    def file_hash(path):
+        try:
+            with open(path, 'rb') as file:
+                return hashlib.sha256(file.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
     @Logging()
     def avatar_request(self, login):
         """The function of requesting the avatar of the client from the server."""
@@ -413,16 +710,14 @@ class ClientTransport:
             ACTION: GET_AVATAR,
             ACCOUNT_NAME: login
         }
-        with LOCK_SOCKET:
-            try:
-                send_msg(self.connection, request)
-                answer = get_msg(self.connection)
-            except (OSError, json.JSONDecodeError):
-                return None
+        try:
+            answer = self.pending_requests.request(request)
+        except OSError:
+            return None
         if RESPONSE in answer and answer[RESPONSE] == 511:
             LOGGER.debug(f'Loaded avatar for {login}')
             img = answer[DATA]
-            img_data = base64.b64decode(img)
+            img_data = img if isinstance(img, bytes) else base64.b64decode(img)
             filename = get_path(login)
             with open(filename, 'wb') as f:
                 f.write(img_data)
@@ -435,25 +730,29 @@ class ClientTransport:
 
     @Logging()
     def send_user_message(self, contact_name, message_text):
+        # The key of the contact has been replaced since the chat was opened
+        if self.encrypt_decrypt.session_key is None and not self.is_received_pubkey(contact_name):
+            return 'Failed to encrypt the message.'
         encrypted_message = self.encrypt_decrypt.message_encryption(message_text)
+        if encrypted_message is None:
+            return 'Failed to encrypt the message.'
+        # Routing fields in the header, the server forwards the ciphertext without decoding it
         message = {
             ACTION: MESSAGE,
             FROM: self.client_login,
             TO: contact_name,
-            TIME: time.time(),
-            MESSAGE_TEXT: encrypted_message
+            TIME: time.time()
         }
-        with LOCK_SOCKET:
-            try:
-                send_msg(self.connection, message)
-                answer = get_msg(self.connection)
-            except (ConnectionResetError, ConnectionAbortedError, OSError):
-                LOGGER.critical('Lost server connection.')
-                return False
-            else:
-                if answer[RESPONSE] == 400:
-                    LOGGER.info(f'{answer[ERROR]}. User {contact_name} is offline.')
-                    return f'User {contact_name} is offline!'
+        try:
+            answer = self.pending_requests.request(message, encrypted_message)
+        except OSError:
+            LOGGER.critical('Lost server connection.')
+            return False
+        if answer.get(RESPONSE) != 200:
+            LOGGER.info(f'Message to {contact_name} is not delivered. Answer server {answer}')
+            if answer.get(RESPONSE) == 400:
+                return f'User {contact_name} is offline!'
+            return answer.get(ERROR, 'Failed to send the message.')
         LOGGER.debug(f'Message sent: {message},from {self.client_login} username {contact_name}')
         with LOCK_DATABASE:
             self.database.save_message(contact_name, 'out', message_text)
@@ -461,26 +760,134 @@ class ClientTransport:
 
     @Logging()
     def send_group_message(self, group_name, message_text):
+        # The text is encrypted once with the key of this user in the group
+        members = None
+        try:
+            for _ in range(GroupKeys.ATTEMPTS):
+                encrypted = self.group_keys.encrypt(group_name, message_text, members)
+                if encrypted is None:
+                    return 'Failed to encrypt the message.'
+                key_id, encrypted_text = encrypted
+                message = {
+                    ACTION: MESSAGE_GROUP,
+                    FROM: self.client_login,
+                    TO: group_name,
+                    TIME: time.time(),
+                    MESSAGE_TEXT: encrypted_text,
+                    KEY_ID: key_id
+                }
+                answer = self.pending_requests.request(message)
+                if answer[RESPONSE] != 409:
+                    break
+                members = answer[LIST_INFO]  # The members have changed, a new key is given to them
+        except OSError:
+            LOGGER.critical('Lost server connection.')
+            return False
+        if answer[RESPONSE] == 409:
+            return 'Failed to give the key to the members of the group.'
+        if answer[RESPONSE] == 200:
+            LOGGER.info(f'Successfully sent a message for the group {group_name} to the server.')
+        with LOCK_DATABASE:
+            self.database.add_group_message(group_name, self.client_login, message_text, answer.get(VERSION))
+        return True
+
+    @Logging()
+    def join_group(self, group_name):
+        """
+        Become a member of the group, the server sends messages of a group only to its members.
+        The answer is not waited for, the group is marked as joined when it comes.
+        """
+        if group_name in self.joined_groups:
+            return
+        try:
+            future = self.pending_requests.send(self._group_message(JOIN, group_name))
+        except OSError:
+            LOGGER.critical('Lost server connection.')
+            return
+        future.add_done_callback(partial(self._joined, group_name))
+
+    def _joined(self, group_name, future):
+        try:
+            answer = future.result()
+        except OSError:
+            return
+        if self._group_answer(JOIN, group_name, answer):
+            self.joined_groups.add(group_name)
+
+    @Logging()
+    def leave_group(self, group_name):
+        try:
+            answer = self.pending_requests.request(self._group_message(LEAVE, group_name))
+        except OSError:
+            LOGGER.critical('Lost server connection.')
+            return False
+        if self._group_answer(LEAVE, group_name, answer):
+            self.joined_groups.discard(group_name)
+            return True
+        return False
+
+    @Logging()
+    def get_messages_group_page(self, group_name, callback, before=None, after=None, limit=MESSAGES_PAGE_LIMIT):
+        """
+        Request a page of the group history: the last messages, the messages before
+        the id before or after the id after. The answer is not waited for: the page is saved
+        in the background, then callback(group_name, number of received messages) is called.
+        """
         message = {
-            ACTION: MESSAGE_GROUP,
-            FROM: self.client_login,
-            TO: group_name,
+            ACTION: GET_MESSAGES_GROUPS,
             TIME: time.time(),
-            MESSAGE_TEXT: message_text
+            USER: self.client_login,
+            ROOM: group_name,
+            LIMIT: limit
         }
-        with LOCK_SOCKET:
-            try:
-                send_msg(self.connection, message)
-                answer = get_msg(self.connection)
-            except (ConnectionResetError, ConnectionAbortedError, OSError):
-                LOGGER.critical('Lost server connection.')
-                return False
-            else:
-                if answer[RESPONSE] == 200:
-                    LOGGER.info(f'Successfully sent a message for the group {group_name} to the server.')
-        with LOCK_DATABASE:
-            self.database.add_group_message(group_name, self.client_login, message_text)
-        return True
+        if before:
+            message[BEFORE] = before
+        if after:
+            message[AFTER] = after
+        try:
+            future = self.pending_requests.send(message)
+        except OSError:
+            LOGGER.critical('Lost server connection.')
+            callback(group_name, 0)
+            return
+        future.add_done_callback(partial(self._page_received, group_name, callback))
+
+    def _page_received(self, group_name, callback, future):
+        # The reader thread cannot wait for the keys of the page that it has to read itself
+        save = threading.Thread(target=self._save_messages_group_page, args=(group_name, callback, future))
+        save.daemon = True
+        save.start()
+
+    def _save_messages_group_page(self, group_name, callback, future):
+        try:
+            answer = future.result()
+        except OSError:
+            LOGGER.critical('Lost server connection.')
+            callback(group_name, 0)
+            return
+        if RESPONSE in answer and answer[RESPONSE] == 202:
+            messages = self.group_keys.decrypt_messages(answer[LIST_INFO])
+            with LOCK_DATABASE:
+                self.database.add_messages_groups(messages)
+            callback(group_name, len(messages))
+            return
+        LOGGER.error(f'Failed to get messages of the group {group_name}. Answer server {answer}')
+        callback(group_name, 0)
+
+    def _group_message(self, action, group_name):
+        return {
+            ACTION: action,
+            TIME: time.time(),
+            USER: self.client_login,
+            ROOM: group_name
+        }
+
+    @staticmethod
+    def _group_answer(action, group_name, answer):
+        if RESPONSE in answer and answer[RESPONSE] == 200:
+            return True
+        LOGGER.error(f'Failed to {action} the group {group_name}. Answer server {answer}')
+        return False
 
     @Logging()
     def add_contact(self, new_contact_name):
@@ -491,7 +898,7 @@ class ClientTransport:
                 self.add_contact_server(new_contact_name)
             except ServerError:
                 LOGGER.error('Failed to send information to server.')
-            except ConnectionResetError:
+            except OSError:
                 LOGGER.error('Server connection lost.')
             else:
                 LOGGER.info(f'New contact added {new_contact_name} at the user {self.client_login}.')
@@ -508,9 +915,7 @@ class ClientTransport:
             USER: self.client_login,
             ACCOUNT_NAME: new_contact_name
         }
-        with LOCK_SOCKET:
-            send_msg(self.connection, message)
-            answer = get_msg(self.connection)
+        answer = self.pending_requests.request(message)
         if RESPONSE in answer and answer[RESPONSE] == 200:
             logging.debug(f'Successful contact creation {new_contact_name} at the user {self.client_login}.')
         else:
@@ -539,9 +944,7 @@ class ClientTransport:
             USER: self.client_login,
             ACCOUNT_NAME: del_contact_name
         }
-        with LOCK_SOCKET:
-            send_msg(self.connection, message)
-            answer = get_msg(self.connection)
+        answer = self.pending_requests.request(message)
         if RESPONSE in answer and answer[RESPONSE] == 200:
             logging.debug(f'Successfully delete a contact {del_contact_name} at the user {self.client_login}')
         else:
@@ -550,18 +953,19 @@ class ClientTransport:
     # @Logging()
     def send_avatar_to_server(self):
         with open(get_path(self.client_login), 'rb') as image_file:
-            encoded_img = base64.b64encode(image_file.read()).decode('utf8')
+            img_data = image_file.read()
+        # Bytes are sent as they are in the binary codec, JSON needs base64
+        if get_codec(self.connection) != BINARY:
+            img_data = base64.b64encode(img_data).decode('utf8')
 
         message = {
             ACTION: SEND_AVATAR,
             USER: {
                 ACCOUNT_NAME: self.client_login,
-                IMAGE: encoded_img
+                IMAGE: img_data
             }
         }
-        with LOCK_SOCKET:
-            send_msg(self.connection, message)
-            answer = get_msg(self.connection)
+        answer = self.pending_requests.request(message)
         if RESPONSE in answer and answer[RESPONSE] == 200:
             logging.debug(f'Successfully saved avatar.')
         else:
@@ -570,8 +974,8 @@ class ClientTransport:
     @Logging()
     def exit_client(self):
         try:
-            send_msg(self.connection, self.create_exit_message(self.client_login))
-        except ConnectionResetError:
+            self.pending_requests.send_message(self.create_exit_message(self.client_login))
+        except OSError:
             LOGGER.critical('Lost server connection.')
             exit(1)
         LOGGER.info('Application shutdown by user command\n.')
@@ -615,8 +1019,12 @@ def loading_window(app, client_transport):
 @Logging()
 def main():
     app = QApplication(sys.argv)
-    server_ip, server_port, client_login, client_password = get_args()
+    server_ip, server_port, client_login, client_password, compression, binary = get_args()
+    # Keys of the login from the command line are loaded in the background while the dialog is open
+    encrypt_decrypt = EncryptDecrypt(client_login) if client_login else None
     client_login, client_password = start_dialog(app, client_login, client_password)
+    if encrypt_decrypt is None or encrypt_decrypt.user_login != client_login:
+        encrypt_decrypt = EncryptDecrypt(client_login)
 
     database = ClientDB(client_login)
 
@@ -625,14 +1033,15 @@ def main():
 
     connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-    encrypt_decrypt = EncryptDecrypt(client_login)
+    pending_requests = PendingRequests(connection)
+
+    group_keys = GroupKeys(client_login, database, encrypt_decrypt, pending_requests, LOCK_DATABASE)
 
-    client_transport = ClientTransport(connection, client_login,
-                                       database, encrypt_decrypt)
+    client_transport = ClientTransport(client_login, database, encrypt_decrypt, pending_requests, group_keys)
 
     loading_client = Client(connection, server_ip, server_port,
                             client_login, client_password, database, mongo_db,
-                            encrypt_decrypt)
+                            encrypt_decrypt, pending_requests, group_keys, compression, binary)
     loading_client.daemon = True
     loading_client.start()
 
@@ -640,14 +1049,19 @@ def main():
     loading_window(app, loading_client)
 
     if loading_client.is_connected:
+        client_transport.start_prefetch()
         main_window = ClientMainWindow(app, client_transport, database)
         main_window.init_ui()
         main_window.make_connection_with_signals(loading_client)
         main_window.setWindowTitle(f'Chat program. User - {client_login}')
         app.exec_()
 
+        loading_client.stop_receiving()
         client_transport.exit_client()
-        connection.close()
+        compressor = get_compressor(loading_client.connection)
+        if compressor:
+            LOGGER.info(f'Sent: {compressor}')
+        loading_client.connection.close()
 
 
 if __name__ == '__main__':
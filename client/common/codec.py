@@ -0,0 +1,208 @@
+"""
+Compact binary encoding of message headers, an alternative to JSON.
+Known keys and action names are written as one byte ids,
+numbers in binary form and bytes as they are, without base64.
+"""
+import struct
+from common.variables import (ACTION, TIME, USER, ACCOUNT_NAME, PUBLIC_KEY, DATA, RESPONSE,
+                              ERROR, ALERT, ROOM, MESSAGE_TEXT, FROM, TO, IMAGE, KDF, CODEC,
+                              LIST_INFO, USERS_VERSION, ADDED, REMOVED, COMPRESSION, ZLIB, REQUEST_ID, VERSION,
+                              BEFORE, AFTER, LIMIT, KEY_ID, TICKET,
+                              PRESENCE, MESSAGE, GET_CONTACTS, DELETE_CONTACT, ADD_CONTACT,
+                              USERS_REQUEST, PUBLIC_KEY_REQUEST, SEND_AVATAR, GET_AVATAR,
+                              GET_GROUPS, GET_MESSAGES_GROUPS, MESSAGE_GROUP, JOIN, LEAVE, EXIT,
+                              KEYS_REQUEST, SENDER_KEY, GET_SENDER_KEYS)
+from common.errors import IncorrectDataNotDictError
+
+# Codecs of the frame header
+JSON = 'json'
+BINARY = 'binary'
+# Supported codecs in the order of preference. Clients offer binary only when asked to (-b):
+# its frames are smaller, but JSON decodes the most common headers as fast or faster.
+CODECS = (BINARY, JSON)
+
+# Ids are the positions in the tables, new names are only added to the end
+KEYS = (ACTION, TIME, USER, ACCOUNT_NAME, PUBLIC_KEY, DATA, RESPONSE, ERROR, ALERT, ROOM,
+        MESSAGE_TEXT, FROM, TO, IMAGE, KDF, CODEC, LIST_INFO, USERS_VERSION, ADDED, REMOVED,
+        COMPRESSION, REQUEST_ID, VERSION, BEFORE, AFTER, LIMIT, KEY_ID, TICKET)
+VALUES = (PRESENCE, MESSAGE, GET_CONTACTS, DELETE_CONTACT, ADD_CONTACT, USERS_REQUEST,
+          PUBLIC_KEY_REQUEST, SEND_AVATAR, GET_AVATAR, GET_GROUPS, GET_MESSAGES_GROUPS,
+          MESSAGE_GROUP, JOIN, LEAVE, EXIT, JSON, BINARY, ZLIB, KEYS_REQUEST, SENDER_KEY,
+          GET_SENDER_KEYS)
+KEY_IDS = {key: number for number, key in enumerate(KEYS, 1)}  # 0 - the key is written as a string
+VALUE_IDS = {value: number for number, value in enumerate(VALUES)}
+
+# Type tags of values
+NONE, TRUE, FALSE, INT8, INT32, INT64, FLOAT, STR, BYTES, LIST, DICT, NAME, STR_LIST = range(13)
+
+INT8_FORMAT = struct.Struct('!b')
+INT32_FORMAT = struct.Struct('!i')
+INT64_FORMAT = struct.Struct('!q')
+FLOAT_FORMAT = struct.Struct('!d')
+
+MAX_DEPTH = 32  # Nesting of lists and dictionaries, headers are only a few levels deep
+
+
+def _write_size(buffer, size):
+    # Variable length: 7 bits in each byte, the high bit means that more bytes follow
+    while size >= 0x80:
+        buffer.append(size & 0x7f | 0x80)
+        size >>= 7
+    buffer.append(size)
+
+
+def _write_str(buffer, value):
+    data = value.encode('utf-8')
+    _write_size(buffer, len(data))
+    buffer += data
+
+
+def _write(buffer, value):
+    if value is None:
+        buffer.append(NONE)
+    elif value is True:
+        buffer.append(TRUE)
+    elif value is False:
+        buffer.append(FALSE)
+    elif isinstance(value, str):
+        number = VALUE_IDS.get(value)
+        if number is None:
+            buffer.append(STR)
+            _write_str(buffer, value)
+        else:
+            buffer.append(NAME)
+            buffer.append(number)
+    elif isinstance(value, int):
+        if -0x80 <= value < 0x80:
+            buffer.append(INT8)
+            buffer += INT8_FORMAT.pack(value)
+        elif -0x80000000 <= value < 0x80000000:
+            buffer.append(INT32)
+            buffer += INT32_FORMAT.pack(value)
+        elif -0x8000000000000000 <= value < 0x8000000000000000:
+            buffer.append(INT64)
+            buffer += INT64_FORMAT.pack(value)
+        else:
+            raise OverflowError(f'Integer {value} does not fit in 64 bits')
+    elif isinstance(value, float):
+        buffer.append(FLOAT)
+        buffer += FLOAT_FORMAT.pack(value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        buffer.append(BYTES)
+        _write_size(buffer, len(value))
+        buffer += value
+    elif isinstance(value, dict):
+        buffer.append(DICT)
+        _write_size(buffer, len(value))
+        for key, item in value.items():
+            number = KEY_IDS.get(key)
+            if number is None:
+                buffer.append(0)
+                _write_str(buffer, str(key))
+            else:
+                buffer.append(number)
+            _write(buffer, item)
+    elif isinstance(value, (list, tuple)) and value and all(type(item) is str for item in value) \
+            and (joined := '\0'.join(value)).count('\0') == len(value) - 1:
+        # Lists of logins: one string separated by zero characters is split much faster than items
+        buffer.append(STR_LIST)
+        _write_str(buffer, joined)
+    elif isinstance(value, (list, tuple)):
+        buffer.append(LIST)
+        _write_size(buffer, len(value))
+        for item in value:
+            _write(buffer, item)
+    else:
+        raise TypeError(f'Object of type {type(value).__name__} cannot be encoded')
+
+
+def _read_size(data, position):
+    size = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        size |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return size, position
+        shift += 7
+
+
+def _read_str(data, position):
+    size, position = _read_size(data, position)
+    end = position + size
+    if end > len(data):
+        raise IndexError(end)
+    return str(data[position:end], 'utf-8'), end
+
+
+def _read(data, position, depth=0):
+    if depth > MAX_DEPTH:
+        raise ValueError('Too deep nesting')
+    tag = data[position]
+    position += 1
+    if tag == NAME:
+        return VALUES[data[position]], position + 1
+    elif tag == STR:
+        return _read_str(data, position)
+    elif tag == DICT:
+        size, position = _read_size(data, position)
+        value = {}
+        for _ in range(size):
+            number = data[position]
+            if number:
+                key = KEYS[number - 1]
+                position += 1
+            else:
+                key, position = _read_str(data, position + 1)
+            value[key], position = _read(data, position, depth + 1)
+        return value, position
+    elif tag == LIST:
+        size, position = _read_size(data, position)
+        value = []
+        for _ in range(size):
+            item, position = _read(data, position, depth + 1)
+            value.append(item)
+        return value, position
+    elif tag == STR_LIST:
+        value, position = _read_str(data, position)
+        return value.split('\0'), position
+    elif tag == INT8:
+        return INT8_FORMAT.unpack_from(data, position)[0], position + 1
+    elif tag == INT32:
+        return INT32_FORMAT.unpack_from(data, position)[0], position + 4
+    elif tag == INT64:
+        return INT64_FORMAT.unpack_from(data, position)[0], position + 8
+    elif tag == FLOAT:
+        return FLOAT_FORMAT.unpack_from(data, position)[0], position + 8
+    elif tag == BYTES:
+        size, position = _read_size(data, position)
+        end = position + size
+        if end > len(data):
+            raise IndexError(end)
+        return bytes(data[position:end]), end
+    elif tag == NONE:
+        return None, position
+    elif tag == TRUE:
+        return True, position
+    elif tag == FALSE:
+        return False, position
+    raise ValueError(f'Unknown type tag {tag}')
+
+
+def pack(msg):
+    """Binary form of the dictionary, OverflowError for integers beyond 64 bits."""
+    buffer = bytearray()
+    _write(buffer, msg)
+    return bytes(buffer)
+
+
+def unpack(body):
+    """Dictionary from its binary form, IncorrectDataNotDictError for any other data."""
+    try:
+        value, position = _read(body, 0)
+    except (IndexError, ValueError, struct.error):
+        raise IncorrectDataNotDictError
+    if not isinstance(value, dict) or position != len(body):
+        raise IncorrectDataNotDictError
+    return value
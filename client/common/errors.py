@@ -21,6 +21,15 @@ class IncorrectCodeError(Exception):
         return f'Invalid code in message - {self.wrong_code}'
 
 
+class IncorrectFrameLengthError(Exception):
+    """Create error wen frame length exceeds the allowed maximum"""
+    def __init__(self, length):
+        self.length = length
+
+    def __str__(self):
+        return f'Invalid frame length - {self.length}'
+
+
 class ServerError(Exception):
     """Create error server with text"""
     def __init__(self, text):
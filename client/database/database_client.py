@@ -2,12 +2,19 @@ import datetime
 import re
 import asyncio
 from sqlalchemy import (create_engine, Column, String, Integer,
-                        DateTime, Text, asc, ForeignKey)
+                        DateTime, Text, LargeBinary, asc, ForeignKey, func)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 Base = declarative_base()
 
+# Collections synchronized with the server by versions
+USERS = 'users'
+CONTACTS = 'contacts'
+GROUPS = 'groups'
+MESSAGES_GROUPS = 'messages_groups'
+KEYS = 'keys'
+
 
 class ClientDB:
     """Create tables in database. Interacts with the database of this client"""
@@ -71,7 +78,8 @@ class ClientDB:
         message = Column(Text)
         date = Column(DateTime)
 
-        def __init__(self, group_id, from_user, message, date):
+        def __init__(self, group_id, from_user, message, date, id=None):
+            self.id = id  # The id of the message on the server
             self.group_id = group_id
             self.from_user = from_user
             self.message = message
@@ -81,6 +89,50 @@ class ClientDB:
             return "<Group messages('%s','%s, '%s','%s)>" % \
                    (self.group_id, self.from_user, self.message, self.date)
 
+    class PublicKeys(Base):
+        # Public keys of contacts, dropped when the server reports a new key
+        __tablename__ = 'public_keys'
+        login = Column(String, primary_key=True)
+        public_key = Column(Text)
+
+        def __init__(self, login, public_key):
+            self.login = login
+            self.public_key = public_key
+
+        def __repr__(self):
+            return "<Public key(%s)>" % self.login
+
+    class SenderKeys(Base):
+        # Group keys of the members, the messages of a member in a group are encrypted with its key
+        __tablename__ = 'sender_keys'
+        id = Column(Integer, primary_key=True)
+        group_name = Column(String)
+        sender = Column(String)
+        key_id = Column(Integer)
+        key = Column(LargeBinary)
+
+        def __init__(self, group_name, sender, key_id, key):
+            self.group_name = group_name
+            self.sender = sender
+            self.key_id = key_id
+            self.key = key
+
+        def __repr__(self):
+            return "<Sender key('%s','%s', '%s')>" % (self.group_name, self.sender, self.key_id)
+
+    class SyncVersions(Base):
+        # The last version of each collection received from the server
+        __tablename__ = 'sync_versions'
+        collection = Column(String, primary_key=True)
+        version = Column(Integer)
+
+        def __init__(self, collection, version):
+            self.collection = collection
+            self.version = version
+
+        def __repr__(self):
+            return "<Version('%s','%s')>" % (self.collection, self.version)
+
     def __init__(self, login):
         # echo - logging, 7200 - seconds restart connect
         self.login = login
@@ -91,6 +143,57 @@ class ClientDB:
         Session = sessionmaker(bind=self.database_engine)
         self.session = Session()
 
+    def get_version(self, collection):
+        # 0 - nothing has been received yet
+        row = self.session.query(self.SyncVersions).filter_by(collection=collection).first()
+        return row.version if row else 0
+
+    def set_version(self, collection, version):
+        self.session.merge(self.SyncVersions(collection, version))
+        self.session.commit()
+
+    def get_public_key(self, login):
+        return self.session.query(self.PublicKeys.public_key).filter_by(login=login).scalar()
+
+    def get_public_keys(self, logins):
+        # {login: public key} of the saved keys
+        query = self.session.query(self.PublicKeys.login, self.PublicKeys.public_key).\
+            filter(self.PublicKeys.login.in_(logins))
+        return dict(query.all())
+
+    def save_public_key(self, login, public_key):
+        self.save_public_keys({login: public_key})
+
+    def save_public_keys(self, public_keys):
+        for login, public_key in public_keys.items():
+            self.session.merge(self.PublicKeys(login, public_key))
+        self.session.commit()
+
+    def del_public_keys(self, logins=None):
+        # logins - users with replaced keys, all keys by default
+        query = self.session.query(self.PublicKeys)
+        if logins is not None:
+            query = query.filter(self.PublicKeys.login.in_(logins))
+        query.delete(synchronize_session=False)
+        self.session.commit()
+
+    def get_sender_key(self, group_name, sender, key_id):
+        return self.session.query(self.SenderKeys.key).\
+            filter_by(group_name=group_name, sender=sender, key_id=key_id).scalar()
+
+    def get_own_sender_key(self, group_name):
+        # (key id, key) of the last key of this user in the group
+        row = self.session.query(self.SenderKeys.key_id, self.SenderKeys.key).\
+            filter_by(group_name=group_name, sender=self.login).order_by(self.SenderKeys.id.desc()).first()
+        return tuple(row) if row else None
+
+    def save_sender_keys(self, group_name, keys):
+        # keys - (sender, key id, key), the saved ones are skipped
+        for sender, key_id, key in keys:
+            if self.get_sender_key(group_name, sender, key_id) is None:
+                self.session.add(self.SenderKeys(group_name, sender, key_id, key))
+        self.session.commit()
+
     def add_contacts(self, contacts_list):
         #  contacts-list - contact list from server
         self.session.query(self.Contacts).delete()
@@ -106,6 +209,25 @@ class ClientDB:
             self.session.add(user_new)
         self.session.commit()
 
+    def update_known_users(self, added, removed):
+        #  Change of the user directory from server, applying it twice does not matter
+        for login in added:
+            if not self.is_user(login):
+                self.session.add(self.UsersKnown(login))
+        if removed:
+            self.session.query(self.UsersKnown).filter(self.UsersKnown.login.in_(removed)).\
+                delete(synchronize_session=False)
+        self.session.commit()
+
+    def update_contacts(self, added, removed):
+        #  Changes of the contact list since the last synchronization
+        for contact in added:
+            self.add_contact(contact)
+        if removed:
+            self.session.query(self.Contacts).filter(self.Contacts.contact.in_(removed)).\
+                delete(synchronize_session=False)
+            self.session.commit()
+
     def get_known_users(self):
         return [user[0] for user in self.session.query(self.UsersKnown.login).all()]
 
@@ -205,35 +327,76 @@ class ClientDB:
             self.session.commit()
 
     def add_groups(self, groups_list):
-        #  groups-list - groups list from server
-        self.session.query(self.Groups).delete()
+        #  groups-list - groups list from server, the ids of kept groups do not change
+        self.session.query(self.Groups).filter(self.Groups.group_name.notin_(groups_list)).\
+            delete(synchronize_session=False)
         self.session.commit()
-        for group in groups_list:
+        self.update_groups(groups_list, [])
+
+    def update_groups(self, added, removed):
+        #  Changes of the groups since the last synchronization
+        for group in added:
             self.add_group(group)
+        if removed:
+            self.session.query(self.Groups).filter(self.Groups.group_name.in_(removed)).\
+                delete(synchronize_session=False)
+            self.session.commit()
+
+    def get_group_id(self, group_name):
+        self.add_group(group_name)
+        return self.session.query(self.Groups.group_id).filter_by(group_name=group_name).scalar()
 
     def get_groups(self):
         return [group[0] for group in self.session.query(self.Groups.group_name).all()]
 
-    def get_messages_group(self, group_name):
-        # Function returning messages group
+    def get_messages_group(self, group_name, limit=None):
+        # Function returning messages group, limit - only the last messages
         group_id = self.session.query(self.Groups).filter_by(group_name=group_name).first().group_id
-        query = self.session.query(self.GroupsMessages).filter_by(group_id=group_id)
+        query = self.session.query(self.GroupsMessages).filter_by(group_id=group_id).\
+            order_by(self.GroupsMessages.id.desc()).limit(limit)
         return [(history_row.from_user, history_row.message, history_row.date)
-                for history_row in query.all()]
-
-    def add_messages_groups(self, messages_groups_list):
-        #  messages_groups_list - from server
-        self.session.query(self.GroupsMessages).delete()
+                for history_row in reversed(query.all())]
+
+    def get_first_message_group(self, group_name):
+        # Id of the oldest saved message of the group, the older ones are requested from the server
+        return self.session.query(func.min(self.GroupsMessages.id)).\
+            join(self.Groups, self.GroupsMessages.group_id == self.Groups.group_id).\
+            filter(self.Groups.group_name == group_name).scalar()
+
+    def count_messages_group(self, group_name):
+        return self.session.query(self.GroupsMessages).\
+            join(self.Groups, self.GroupsMessages.group_id == self.Groups.group_id).\
+            filter(self.Groups.group_name == group_name).count()
+
+    def add_messages_groups(self, messages_groups_list, replace=False):
+        #  messages_groups_list - (id, group name, from user, message, date) from server,
+        #  messages that are already saved are skipped, replace - the whole history from server
+        if replace:
+            self.session.query(self.GroupsMessages).delete()
+            saved = set()
+        else:
+            ids = [message[0] for message in messages_groups_list]
+            saved = {row[0] for row in
+                     self.session.query(self.GroupsMessages.id).filter(self.GroupsMessages.id.in_(ids))}
+        group_ids = dict()
         for message in messages_groups_list:
-            message_new = self.GroupsMessages(group_id=message[0],
-                                              from_user=message[1],
-                                              message=message[2],
-                                              date=datetime.datetime.strptime(message[3], '%y-%m-%d %H:%M:%S'))
+            if message[0] in saved:
+                continue
+            if message[1] not in group_ids:
+                group_ids[message[1]] = self.get_group_id(message[1])
+            message_new = self.GroupsMessages(group_id=group_ids[message[1]],
+                                              from_user=message[2],
+                                              message=message[3],
+                                              date=datetime.datetime.strptime(message[4], '%y-%m-%d %H:%M:%S'),
+                                              id=message[0])
             self.session.add(message_new)
         self.session.commit()
 
-    def add_group_message(self, group_name, from_user, message):
+    def add_group_message(self, group_name, from_user, message, message_id=None):
+        # message_id - the id on the server, the message is saved once
+        if message_id is not None and self.session.query(self.GroupsMessages).filter_by(id=message_id).count():
+            return
         group_id = self.session.query(self.Groups).filter_by(group_name=group_name).first().group_id
-        new_message = self.GroupsMessages(group_id, from_user, message, date=datetime.datetime.now())
+        new_message = self.GroupsMessages(group_id, from_user, message, date=datetime.datetime.now(), id=message_id)
         self.session.add(new_message)
         self.session.commit()
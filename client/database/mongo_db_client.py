@@ -15,6 +15,12 @@ class MongoDbClient:
         for user in users_all:
             self.users.insert_one({'login': f'{user}'})
 
+    def update_known_users(self, added, removed):
+        for user in added:
+            self.users.update_one({'login': f'{user}'}, {'$set': {'login': f'{user}'}}, upsert=True)
+        if removed:
+            self.users.delete_many({'login': {'$in': [f'{user}' for user in removed]}})
+
     def get_known_users(self):
         return [login['login'] for login in self.users.find()]
 
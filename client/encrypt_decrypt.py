@@ -1,11 +1,19 @@
 """Message encryption module"""
 import os
 import sys
-import logging
 import base64
+import struct
+import binascii
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from Cryptodome.PublicKey import RSA
-from Cryptodome.Cipher import PKCS1_OAEP
+from Cryptodome.Cipher import PKCS1_OAEP, AES
 from Cryptodome.Hash import SHA1
+from Cryptodome.Random import get_random_bytes
+from Cryptodome.Util.asn1 import DerSequence
 from common.decos import Logging
 
 LOGGER = logging.getLogger('client')
@@ -18,24 +26,90 @@ class EncryptDecrypt:
     INPUT_BLOCK_SIZE = int(KEY_SIZE / 8 - 2 * HASH_SIZE - 2)
     OUTPUT_BLOCK_SIZE = 256  # Encrypted block key plus encrypted block
 
+    # Hybrid messages: version, AES key encrypted with RSA, nonce, tag, text encrypted with AES-GCM.
+    # Messages of older clients are RSA blocks only.
+    HYBRID_VERSION = b'\x02'
+    AES_KEY_SIZE = 32
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    # Group messages: version, id of the group key of the sender, nonce, tag, text encrypted with AES-GCM,
+    # in base64, the server stores and sends it as the text of the message.
+    GROUP_VERSION = b'\x03'
+    KEY_ID_FORMAT = struct.Struct('!I')
+    RECEIVED_KEYS_SIZE = 256  # Decrypted session keys of senders kept in memory
+    CIPHERS_SIZE = 64  # Imported public keys of contacts kept in memory
+
     """The class creates keys, encodes and decodes messages"""
-    def __init__(self, user_login):
-        """Get keys, create object - decoder"""
-        self.keys = self._get_keys(user_login)
-        self.decrypter = PKCS1_OAEP.new(self.keys)
+    def __init__(self, user_login, keys=None):
+        """Keys are loaded or generated in the background, they are waited for at the first use"""
+        self.user_login = user_login
+        self.keys_future = Future()
+        if keys:
+            self._set_keys(keys)
+        else:
+            loader = threading.Thread(target=self._load_keys)
+            loader.daemon = True
+            loader.start()
         self.current_encrypt = None
+        self.current_login = None  # Contact of the current chat
+        # (session key, the key encrypted with RSA) of the current chat, RSA is used once, not for each message.
+        # One attribute, so that another thread never sees a key with the encrypted form of another one.
+        self.session_key = None
+        self.received_keys = dict()  # Encrypted session key -> session key
+        # (login, key fingerprint) -> (RSA cipher, session key), the last used at the end
+        self.ciphers = OrderedDict()
+        self.ciphers_lock = threading.Lock()
 
-    @Logging()
-    def _get_keys(self, user_login):
-        """Function create new keys or import from file"""
+    @property
+    def keys(self):
+        return self.keys_future.result()[0]
 
+    @property
+    def decrypter(self):
+        return self.keys_future.result()[1]
+
+    def _set_keys(self, keys):
+        self.keys_future.set_result((keys, PKCS1_OAEP.new(keys)))
+
+    def _load_keys(self):
+        try:
+            keys = self._get_keys(self.user_login)
+        except Exception as error:
+            LOGGER.critical(f'Failed to load the keys of {self.user_login}: {error}')
+            self.keys_future.set_exception(error)
+        else:
+            self._set_keys(keys)
+
+    @staticmethod
+    def keys_dir():
+        """Directory of the key files."""
         #  for cx-Freeze - exe file
         if getattr(sys, 'frozen', False):
-            dir_path = os.path.dirname(sys.executable)
-        else:
-            dir_path = os.path.dirname(os.path.realpath(__file__))
+            return os.path.dirname(sys.executable)
+        return os.path.dirname(os.path.realpath(__file__))
 
+    @Logging()
+    def _get_keys(self, user_login):
+        """
+        Function create new keys or import from file.
+        The private key is also saved in DER, it is read without the slow checks
+        of the PEM import, the key was checked when the file was written.
+        """
+
+        dir_path = self.keys_dir()
         file_path = os.path.join(dir_path, f'{user_login}.key')
+        der_path = os.path.join(dir_path, f'{user_login}.der')
+        # The cache is not used if the PEM file has been removed or replaced after it
+        if os.path.exists(der_path) and os.path.exists(file_path) and \
+                os.path.getmtime(der_path) >= os.path.getmtime(file_path):
+            try:
+                with open(der_path, 'rb') as file:
+                    # RSAPrivateKey: version, n, e, d, p, q, ...
+                    key_numbers = DerSequence().decode(file.read())
+                return RSA.construct(tuple(key_numbers[1:6]), consistency_check=False)
+            except (ValueError, IndexError, TypeError):
+                LOGGER.warning(f'Damaged key cache {der_path}, the key is read again.')
+
         if not os.path.exists(file_path):
             keys = RSA.generate(self.KEY_SIZE, os.urandom)
             with open(file_path, 'wb') as file:
@@ -43,6 +117,8 @@ class EncryptDecrypt:
         else:
             with open(file_path, 'rb') as file:
                 keys = RSA.import_key(file.read())
+        with open(der_path, 'wb') as file:
+            file.write(keys.export_key(format='DER', pkcs=1))
         return keys
 
     @Logging()
@@ -50,14 +126,150 @@ class EncryptDecrypt:
         """Function passes the public key"""
         return self.keys.publickey().export_key()
 
+    @staticmethod
+    def fingerprint(public_key):
+        """SHA-256 of the public key in PEM."""
+        if isinstance(public_key, str):
+            public_key = public_key.encode('ascii')
+        return hashlib.sha256(public_key).hexdigest()
+
     @Logging()
-    def create_current_encrypt(self, current_chat_key):
-        """Create an encryption object."""
-        self.current_encrypt = PKCS1_OAEP.new(key=RSA.import_key(current_chat_key), hashAlgo=self.HASH_FUNCTION)
+    def create_current_encrypt(self, current_chat_key, login=None):
+        """
+        Select the encryption object of the chat. The key of a contact is imported
+        and its session key is encrypted once, while the key stays the same.
+        """
+        self.current_encrypt, self.session_key = self._cipher(current_chat_key, login)
+        self.current_login = login
+
+    def prepare_encrypt(self, public_key, login):
+        """Import the key of a contact in advance, its chat is opened without RSA work."""
+        self._cipher(public_key, login)
+
+    def _cipher(self, current_chat_key, login):
+        cache_key = (login, self.fingerprint(current_chat_key))
+        with self.ciphers_lock:
+            cipher = self.ciphers.get(cache_key)
+            if cipher is not None:
+                self.ciphers.move_to_end(cache_key)
+        if cipher is None:
+            encrypt = PKCS1_OAEP.new(key=RSA.import_key(current_chat_key), hashAlgo=self.HASH_FUNCTION)
+            session_key = get_random_bytes(self.AES_KEY_SIZE)
+            cipher = (encrypt, (session_key, encrypt.encrypt(session_key)))
+            with self.ciphers_lock:
+                self.ciphers[cache_key] = cipher
+                if len(self.ciphers) > self.CIPHERS_SIZE:
+                    self.ciphers.popitem(last=False)  # The least recently used
+        return cipher
+
+    def forget(self, login):
+        """The key of the contact has been replaced, its encryption objects are dropped."""
+        with self.ciphers_lock:
+            for cache_key in [cache_key for cache_key in self.ciphers if cache_key[0] == login]:
+                del self.ciphers[cache_key]
+        if login == self.current_login:
+            # The open chat is encrypted with the new key from the next message
+            self.session_key = None
+            self.current_encrypt = None
 
     @Logging()
     def message_encryption(self, message_text):
-        """Message encryption before sending."""
+        """Message encryption before sending, the result is bytes."""
+        try:
+            session_key, wrapped_key = self.session_key
+            cipher = AES.new(session_key, AES.MODE_GCM, nonce=get_random_bytes(self.NONCE_SIZE))
+            cipher.update(self.HYBRID_VERSION)
+            encrypted_text, tag = cipher.encrypt_and_digest(message_text.encode('utf8'))
+        except (ValueError, TypeError):
+            LOGGER.warning('Failed to encode message.')
+            return None
+        return b''.join((self.HYBRID_VERSION, wrapped_key, cipher.nonce, tag, encrypted_text))
+
+    def _hybrid_decryption(self, encrypted_message):
+        # None if the message is not a hybrid one
+        key_size = self.keys.size_in_bytes()
+        header_size = len(self.HYBRID_VERSION) + key_size + self.NONCE_SIZE + self.TAG_SIZE
+        if encrypted_message[:1] != self.HYBRID_VERSION or len(encrypted_message) < header_size:
+            return None
+        wrapped_key = encrypted_message[1:1 + key_size]
+        nonce = encrypted_message[1 + key_size:1 + key_size + self.NONCE_SIZE]
+        tag = encrypted_message[header_size - self.TAG_SIZE:header_size]
+        try:
+            session_key = self.received_keys.get(wrapped_key)
+            if session_key is None:
+                session_key = self.decrypter.decrypt(wrapped_key)
+            cipher = AES.new(session_key, AES.MODE_GCM, nonce=nonce)
+            cipher.update(self.HYBRID_VERSION)
+            text = cipher.decrypt_and_verify(encrypted_message[header_size:], tag).decode('utf8')
+        except (ValueError, TypeError):
+            return None
+        if wrapped_key not in self.received_keys:
+            if len(self.received_keys) >= self.RECEIVED_KEYS_SIZE:
+                del self.received_keys[next(iter(self.received_keys))]  # The oldest key
+            self.received_keys[wrapped_key] = session_key
+        return text
+
+    @classmethod
+    def new_group_key(cls):
+        """(key id, key) of a new group key, the id fits in a signed 32-bit number."""
+        return cls.KEY_ID_FORMAT.unpack(get_random_bytes(cls.KEY_ID_FORMAT.size))[0] >> 1, \
+            get_random_bytes(cls.AES_KEY_SIZE)
+
+    def wrap_group_key(self, group_key, public_key):
+        """
+        The group key encrypted with the public key of a member. The key is imported without
+        the cache of chats, the members of a large group would push the contacts out of it.
+        """
+        return PKCS1_OAEP.new(key=RSA.import_key(public_key), hashAlgo=self.HASH_FUNCTION).encrypt(group_key)
+
+    def unwrap_group_key(self, wrapped_key):
+        """The group key of another member, None if it was not encrypted for this user."""
+        try:
+            return self.decrypter.decrypt(wrapped_key)
+        except (ValueError, TypeError):
+            LOGGER.warning('Failed to decode the group key.')
+            return None
+
+    def group_encryption(self, key_id, group_key, message_text):
+        """Encryption of a group message with the key of the sender, one for all members."""
+        header = self.GROUP_VERSION + self.KEY_ID_FORMAT.pack(key_id)
+        cipher = AES.new(group_key, AES.MODE_GCM, nonce=get_random_bytes(self.NONCE_SIZE))
+        cipher.update(header)
+        encrypted_text, tag = cipher.encrypt_and_digest(message_text.encode('utf8'))
+        return base64.b64encode(b''.join((header, cipher.nonce, tag, encrypted_text))).decode('ascii')
+
+    def _group_message(self, message_text):
+        # (header, key id, data) of an encrypted group message, None for the plain text of older clients
+        header_size = len(self.GROUP_VERSION) + self.KEY_ID_FORMAT.size
+        try:
+            data = base64.b64decode(message_text, validate=True)
+        except (binascii.Error, ValueError, TypeError):
+            return None
+        if data[:1] != self.GROUP_VERSION or len(data) < header_size + self.NONCE_SIZE + self.TAG_SIZE:
+            return None
+        return data[:header_size], self.KEY_ID_FORMAT.unpack_from(data, 1)[0], data[header_size:]
+
+    def group_key_id(self, message_text):
+        """Id of the key of the group message, None if the message is not encrypted."""
+        group_message = self._group_message(message_text)
+        return group_message and group_message[1]
+
+    def group_decryption(self, group_key, message_text):
+        """Text of the group message, None if it cannot be decrypted with the key."""
+        header, key_id, data = self._group_message(message_text)
+        nonce = data[:self.NONCE_SIZE]
+        tag = data[self.NONCE_SIZE:self.NONCE_SIZE + self.TAG_SIZE]
+        try:
+            cipher = AES.new(group_key, AES.MODE_GCM, nonce=nonce)
+            cipher.update(header)
+            return cipher.decrypt_and_verify(data[self.NONCE_SIZE + self.TAG_SIZE:], tag).decode('utf8')
+        except (ValueError, TypeError):
+            LOGGER.warning('Failed to decode the group message.')
+            return None
+
+    @Logging()
+    def message_encryption_rsa(self, message_text):
+        """Encryption of older clients: the text in RSA blocks."""
         try:
             message_text_encrypted = bytearray()
 
@@ -70,20 +282,20 @@ class EncryptDecrypt:
                 block = message_text
                 message_text_encrypted += self.current_encrypt.encrypt(block.encode('utf8'))
 
-            message_text_encrypted_base64 = base64.b64encode(
-                message_text_encrypted).decode('ascii')
-
         except (ValueError, TypeError):
-            LOGGER.warning(
-                self, 'Error', 'Failed to encode message.')
+            LOGGER.warning('Failed to encode message.')
             return None
-        return message_text_encrypted_base64
+        return bytes(message_text_encrypted)
 
     @Logging()
     def message_decryption(self, encrypted_message):
         """Message decryption function after receiving."""
         try:
-            encrypted_message_str = base64.b64decode(encrypted_message)
+            encrypted_message_str = bytes(encrypted_message)
+            # The first byte of an RSA block of an older client may also be the version
+            decrypted_message = self._hybrid_decryption(encrypted_message_str)
+            if decrypted_message is not None:
+                return decrypted_message
             decrypted_message = ''
             while len(encrypted_message_str) > self.OUTPUT_BLOCK_SIZE:
                 block = encrypted_message_str[:self.OUTPUT_BLOCK_SIZE]
@@ -97,7 +309,6 @@ class EncryptDecrypt:
                 decrypted_message += decrypted.decode('utf8')
                 
         except (ValueError, TypeError):
-            LOGGER.warning(
-                self, 'Error', 'Failed to decode message.')
+            LOGGER.warning('Failed to decode message.')
             return None
         return decrypted_message
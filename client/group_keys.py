@@ -0,0 +1,155 @@
+"""Group keys of the senders, a group message is encrypted once for all members"""
+import time
+import base64
+import logging
+from common.variables import (ACTION, TIME, USER, ROOM, KEY_ID, DATA, LIST_INFO, RESPONSE, ERROR,
+                              SENDER_KEY, GET_SENDER_KEYS, PUBLIC_KEY_REQUEST)
+
+LOGGER = logging.getLogger('client')
+
+UNREADABLE_MESSAGE = 'The message cannot be decrypted.'
+
+
+class GroupKeys:
+    """
+    Each member encrypts its messages in a group with its own AES key. The key is encrypted
+    with RSA once for each member and kept on the server, so a message costs one AES encryption
+    and the server sends the same ciphertext to all members. When the members change
+    the server rejects the key, the sender makes a new one for the current members.
+    """
+    ATTEMPTS = 3  # Members may change while a new key is given to them
+
+    def __init__(self, client_login, database, encrypt_decrypt, pending_requests, lock):
+        self.client_login = client_login
+        self.database = database
+        self.encrypt_decrypt = encrypt_decrypt
+        self.pending_requests = pending_requests
+        self.lock = lock  # Lock of the database
+
+    def encrypt(self, group_name, message_text, members=None):
+        """
+        (key id, encrypted text) of the message, None if there is no key for the group.
+        members - the current members of the group if the server has rejected the last key.
+        """
+        with self.lock:
+            own_key = self.database.get_own_sender_key(group_name) if members is None else None
+        if own_key is None:
+            # The server answers with the members if they are not the ones the key is given to
+            own_key = self.new_key(group_name, members or [self.client_login])
+            if own_key is None:
+                return None
+        key_id, key = own_key
+        return key_id, self.encrypt_decrypt.group_encryption(key_id, key, message_text)
+
+    def new_key(self, group_name, members):
+        """Make a new key of this user in the group and give it to the members, (key id, key) or None."""
+        key_id, key = self.encrypt_decrypt.new_group_key()
+        for _ in range(self.ATTEMPTS):
+            wrapped_keys = self.wrap(key, members)
+            if wrapped_keys is None:
+                return None
+            answer = self.pending_requests.request({
+                ACTION: SENDER_KEY,
+                TIME: time.time(),
+                USER: self.client_login,
+                ROOM: group_name,
+                KEY_ID: key_id,
+                DATA: wrapped_keys
+            })
+            if answer.get(RESPONSE) == 200:
+                with self.lock:
+                    self.database.save_sender_keys(group_name, [(self.client_login, key_id, key)])
+                LOGGER.info(f'New key of the group {group_name} is given to {len(members)} members.')
+                return key_id, key
+            if answer.get(RESPONSE) != 409:
+                LOGGER.error(f'Failed to give the key of the group {group_name}. Answer server {answer.get(ERROR)}')
+                return None
+            members = answer[LIST_INFO]  # The members have changed
+        LOGGER.error(f'Failed to give the key of the group {group_name}, the members keep changing.')
+        return None
+
+    def wrap(self, key, members):
+        """{login: the key encrypted with the public key of the member in base64}, None if a key is missing."""
+        with self.lock:
+            public_keys = self.database.get_public_keys(members)
+        if self.client_login in members:
+            public_keys[self.client_login] = self.encrypt_decrypt.get_pubkey_user()
+        missing = [login for login in members if login not in public_keys]
+        if missing:
+            answer = self.pending_requests.request({
+                ACTION: PUBLIC_KEY_REQUEST,
+                TIME: time.time(),
+                LIST_INFO: missing
+            })
+            received_keys = answer[DATA] if answer.get(RESPONSE) == 202 else {}
+            with self.lock:
+                self.database.save_public_keys(received_keys)
+            public_keys.update(received_keys)
+        missing = [login for login in members if login not in public_keys]
+        if missing:
+            LOGGER.error(f'There are no public keys of the members {missing}.')
+            return None
+        return {login: base64.b64encode(self.encrypt_decrypt.wrap_group_key(key, public_keys[login])).
+                decode('ascii') for login in members}
+
+    def fetch(self, group_name):
+        """Save the keys of the group given to this user by other members."""
+        try:
+            answer = self.pending_requests.request({
+                ACTION: GET_SENDER_KEYS,
+                TIME: time.time(),
+                USER: self.client_login,
+                ROOM: group_name
+            })
+        except OSError:
+            LOGGER.error(f'Failed to get the keys of the group {group_name}.')
+            return
+        if answer.get(RESPONSE) != 202:
+            LOGGER.error(f'Failed to get the keys of the group {group_name}. Answer server {answer.get(ERROR)}')
+            return
+        keys = []
+        for sender, key_id, wrapped_key in answer[LIST_INFO]:
+            with self.lock:
+                is_saved = self.database.get_sender_key(group_name, sender, key_id) is not None
+            if not is_saved:
+                key = self.encrypt_decrypt.unwrap_group_key(base64.b64decode(wrapped_key))
+                if key is not None:
+                    keys.append((sender, key_id, key))
+        with self.lock:
+            self.database.save_sender_keys(group_name, keys)
+
+    def save_pushed(self, group_name, sender, key_id, wrapped_key):
+        """The new key of a member pushed by the server before its messages."""
+        key = self.encrypt_decrypt.unwrap_group_key(base64.b64decode(wrapped_key))
+        if key is not None:
+            with self.lock:
+                self.database.save_sender_keys(group_name, [(sender, key_id, key)])
+
+    def decrypt(self, group_name, sender, message_text):
+        """Text of the group message, None if the key of the message is unknown."""
+        key_id = self.encrypt_decrypt.group_key_id(message_text)
+        if key_id is None:
+            return message_text  # Plain text of older clients
+        with self.lock:
+            key = self.database.get_sender_key(group_name, sender, key_id)
+        if key is None:
+            return None
+        text = self.encrypt_decrypt.group_decryption(key, message_text)
+        return UNREADABLE_MESSAGE if text is None else text
+
+    def decrypt_messages(self, messages):
+        """
+        Decrypt (id, group name, from user, message, date) from the server,
+        unknown keys are requested once for each group.
+        """
+        fetched = set()
+        decrypted_messages = []
+        for message_id, group_name, sender, message_text, date in messages:
+            text = self.decrypt(group_name, sender, message_text)
+            if text is None and group_name not in fetched:
+                fetched.add(group_name)
+                self.fetch(group_name)
+                text = self.decrypt(group_name, sender, message_text)
+            decrypted_messages.append((message_id, group_name, sender,
+                                       UNREADABLE_MESSAGE if text is None else text, date))
+        return decrypted_messages
@@ -9,7 +9,7 @@ class LoadingWindow(QDialog):
     def __init__(self, app):
         self.app = app
         self.message_window = QMessageBox()
-        self.progress = 19
+        self.progress = 3  # Connection and five synchronization steps, 16 each
         super().__init__()
 
     def init_ui(self):
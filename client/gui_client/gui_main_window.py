@@ -3,18 +3,23 @@ import os
 import datetime
 from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox
 from PyQt5.QtGui import QStandardItemModel, QStandardItem, QFont, QPixmap
-from PyQt5.QtCore import Qt, pyqtSlot, QSize
+from PyQt5.QtCore import Qt, pyqtSlot, pyqtSignal, QSize
 from gui_client.main_window_config import Ui_MainWindow
 from gui_client.gui_add_contact import AddContactDialog
 from gui_client.gui_del_contact import DelContactDialog
 from database.database_client import ClientDB
 from gui_client.gui_image import ImageAddForm
 from gui_client.text_edit import TextEdit
-from common.variables import get_path
+from common.variables import get_path, MESSAGES_PAGE_LIMIT
+
+HISTORY_LENGTH = 20  # Number of the last messages shown in the chat
 
 
 class ClientMainWindow(QMainWindow):
     """Class of the main user interaction window."""
+    # Pages of the group history are saved by the transport in the background
+    group_page_signal = pyqtSignal(str, int)
+
     def __init__(self, app, client_transport, database_client):
         self.app = app
         self.client_transport = client_transport
@@ -24,6 +29,8 @@ class ClientMainWindow(QMainWindow):
         self.user_interface = None
         self.current_chat = None
         self.current_group = None
+        self.group_history_length = HISTORY_LENGTH  # Grows when the group history is scrolled up
+        self.page_requested = False  # An older page of the group is being loaded
         super().__init__()
 
     def init_ui(self):
@@ -68,6 +75,9 @@ class ClientMainWindow(QMainWindow):
         self.user_interface.contactsListView.doubleClicked.connect(self.select_active_user)
         # Double-click on the groups list
         self.user_interface.groupslistView.doubleClicked.connect(self.select_active_group)
+        # Older messages of the group are loaded at the top of the history
+        self.user_interface.messageHistoryEdit.verticalScrollBar().valueChanged.connect(self.history_scrolled)
+        self.group_page_signal.connect(self.show_group_page)
 
         self.user_interface.searchContactPushButton.clicked.connect(self.search_contact)
         self.user_interface.searchMessagePushButton.clicked.connect(self.search_message)
@@ -151,14 +161,53 @@ class ClientMainWindow(QMainWindow):
     def select_active_group(self):
         self.current_chat = None
         self.current_group = self.user_interface.groupslistView.currentIndex().data()
+        # Messages of the group come only after joining it, the saved history is shown until the last page comes
+        self.client_transport.join_group(self.current_group)
+        self.client_transport.get_messages_group_page(self.current_group, self.group_page_signal.emit)
+        self.group_history_length = HISTORY_LENGTH
+        self.page_requested = False
         self.set_active()
         self.history_group_update()
 
     def history_group_update(self):
-        list_message = sorted(self.database_client.get_messages_group(self.current_group),
-                              key=lambda item: item[2])  # sort by date
+        list_message = self.database_client.get_messages_group(self.current_group, self.group_history_length)
+        self.show_history(list_message, self.group_history_length)
+
+    def history_scrolled(self, value):
+        """Show older messages of the group when the history is scrolled to the top."""
+        scroll_bar = self.user_interface.messageHistoryEdit.verticalScrollBar()
+        if not self.current_group or self.page_requested \
+                or value != scroll_bar.minimum() or scroll_bar.maximum() == 0:
+            return
+        saved = self.database_client.count_messages_group(self.current_group)
+        if saved > self.group_history_length:
+            self.show_older_messages()
+            return
+        first_message = self.database_client.get_first_message_group(self.current_group)
+        if first_message:
+            self.page_requested = True
+            self.client_transport.get_messages_group_page(self.current_group, self.group_page_signal.emit,
+                                                          before=first_message)
+
+    def show_older_messages(self):
+        scroll_bar = self.user_interface.messageHistoryEdit.verticalScrollBar()
+        self.group_history_length += MESSAGES_PAGE_LIMIT
+        distance = scroll_bar.maximum() - scroll_bar.value()
+        self.history_group_update()
+        scroll_bar.setValue(scroll_bar.maximum() - distance)  # The same messages stay in view
 
-        self.show_history(list_message)
+    @pyqtSlot(str, int)
+    def show_group_page(self, group_name, received):
+        """Slot of the received pages of the group history."""
+        if group_name != self.current_group:
+            return
+        if not self.page_requested:
+            self.history_group_update()
+            return
+        self.page_requested = False
+        if received:
+            self.show_older_messages()
+        # Otherwise the whole history is shown
 
     def set_active_group(self):
         self.set_active()
@@ -186,7 +235,9 @@ class ClientMainWindow(QMainWindow):
 
             self.history_list_update()
 
-            if self.client_transport.avatar_request(self.current_chat):
+            # Avatars of contacts are updated in the background after login
+            if os.path.exists(get_path(self.current_chat)) or \
+                    self.client_transport.avatar_request(self.current_chat):
                 self.avatar_contact_show(self.current_chat)
         else:
             self.message_window.warning(
@@ -220,8 +271,10 @@ class ClientMainWindow(QMainWindow):
                 if not is_success:
                     self.message_window.critical(self, 'Error', 'Lost server connection!')
                     self.close()
-                else:
+                elif is_success is True:
                     self.add_message_history(message_text)
+                else:
+                    self.message_window.warning(self, 'Warning', is_success)
 
     def add_message_history(self, message):
         """Add message user in history"""
@@ -249,18 +302,21 @@ class ClientMainWindow(QMainWindow):
                 self.user_interface.messageHistoryEdit.insertHtml(f'<br>')
         self.user_interface.messageHistoryEdit.ensureCursorVisible()
 
-    def show_history(self, list_message):
+    def show_history(self, list_message, history_length=HISTORY_LENGTH):
+        scroll_bar = self.user_interface.messageHistoryEdit.verticalScrollBar()
+        scroll_bar.blockSignals(True)  # Rebuilding the history is not scrolling
         self.user_interface.messageHistoryEdit.clear()
 
         length = len(list_message)
         start_index = 0
-        if length > 20:
-            start_index = length - 20
+        if length > history_length:
+            start_index = length - history_length
 
         if self.current_chat:
             self.show_history_contact(start_index, length, list_message)
         elif self.current_group:
             self.show_history_group(start_index, length, list_message)
+        scroll_bar.blockSignals(False)
 
     def show_history_contact(self, start_index, length, list_message):
         for i in range(start_index, length):
@@ -0,0 +1,68 @@
+"""Requests to the server waiting for their answers"""
+import itertools
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from common.utils import send_msg
+from common.variables import REQUEST_ID, REQUEST_TIMEOUT
+
+
+class PendingRequests:
+    """
+    Requests are sent with an id that the server repeats in the answer.
+    Answers are read by one reader thread and passed to the futures of the requests,
+    so any number of threads can wait for answers at the same time.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()  # Frames of different threads must not be mixed in the socket
+        self.ids = itertools.count(1)
+        self.futures = dict()  # Request id -> future of the answer
+
+    def send(self, request, payload=b''):
+        """Send the request, returns the future of the answer."""
+        future = Future()
+        with self.lock:
+            request_id = future.request_id = request[REQUEST_ID] = next(self.ids)
+            self.futures[request_id] = future
+            try:
+                send_msg(self.connection, request, payload)
+            except Exception:
+                del self.futures[request_id]
+                raise
+        return future
+
+    def request(self, request, payload=b'', timeout=REQUEST_TIMEOUT):
+        """Send the request and wait for the answer, TimeoutError if there is no answer."""
+        return self.result(self.send(request, payload), timeout)
+
+    def result(self, future, timeout=REQUEST_TIMEOUT):
+        """Wait for the answer to a sent request."""
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f'No answer to the request {future.request_id}.')
+        finally:
+            with self.lock:
+                self.futures.pop(future.request_id, None)
+
+    def send_message(self, message, payload=b''):
+        """Send a message that has no answer."""
+        with self.lock:
+            send_msg(self.connection, message, payload)
+
+    def resolve(self, answer):
+        """Pass the answer to its request, False if no one is waiting for it."""
+        with self.lock:
+            future = self.futures.pop(answer.get(REQUEST_ID), None)
+        if future is None:
+            return False
+        future.set_result(answer)
+        return True
+
+    def fail_all(self, error):
+        """The connection is lost, all waiting requests get the error."""
+        with self.lock:
+            futures = list(self.futures.values())
+            self.futures.clear()
+        for future in futures:
+            future.set_exception(error)
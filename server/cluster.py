@@ -0,0 +1,189 @@
+"""Several server processes sharing one listening port"""
+import os
+import socket
+import logging
+import selectors
+import tempfile
+import threading
+import json
+from common.variables import ACTION, ACCOUNT_NAME, TO, DATA
+from common.utils import encode_msg, get_decoder, get_frame
+from common.errors import IncorrectDataNotDictError, IncorrectFrameLengthError
+
+LOGGER = logging.getLogger('server')
+
+# Actions between workers and the broker
+ONLINE = 'online'  # the user has logged in to the worker
+OFFLINE = 'offline'  # the user has left the worker
+KICK = 'kick'  # the login is already taken on another worker
+REPLACE = 'replace'  # the user has logged in with a ticket, its session on another worker is stale
+ROUTE = 'route'  # deliver the frame in the payload to the worker of the user TO
+PUBLISH = 'publish'  # deliver EVENT with DATA to all other workers
+EVENT = 'event'
+
+# Events published to all workers
+GROUP_MESSAGE = 'group_message'
+USERS_CHANGED = 'users_changed'
+GROUPS_CHANGED = 'groups_changed'
+KEY_CHANGED = 'key_changed'
+GROUP_KEY = 'group_key'
+
+
+def broker_path():
+    return os.path.join(tempfile.gettempdir(), f'messenger_broker_{os.getpid()}.sock')
+
+
+class Broker(threading.Thread):
+    """
+    Routing layer of the workers, runs in the main process.
+    Knows which worker serves which user, forwards personal messages
+    to the worker of the recipient and published events to all workers.
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.daemon = True
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        # The socket listens before the workers are started, so they can connect at once
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.selector = selectors.DefaultSelector()
+        self.workers = set()
+        self.owners = dict()  # User name -> connection of the worker
+
+    def run(self):
+        self.selector.register(self.listener, selectors.EVENT_READ, self.accept_worker)
+        while True:
+            for key, mask in self.selector.select():
+                callback = key.data
+                callback(key.fileobj)
+
+    def accept_worker(self, listener):
+        worker, address = listener.accept()
+        self.workers.add(worker)
+        self.selector.register(worker, selectors.EVENT_READ, self.worker_events)
+        for name in self.owners:
+            self.send(worker, encode_msg({ACTION: ONLINE, ACCOUNT_NAME: name}))
+
+    def worker_events(self, worker):
+        decoder = get_decoder(worker)
+        try:
+            decoder.read_from(worker)
+            while decoder.frames:
+                frame = decoder.frames.popleft()
+                self.process_message(worker, frame.message(), frame)
+        except (OSError, IncorrectFrameLengthError, IncorrectDataNotDictError, json.decoder.JSONDecodeError):
+            self.remove_worker(worker)
+
+    def process_message(self, worker, message, frame):
+        # Frames are forwarded to the workers as they are received
+        action = message[ACTION]
+        if action == ONLINE:
+            name = message[ACCOUNT_NAME]
+            owner = self.owners.get(name)
+            if owner is not None and owner is not worker:
+                # The same login on two workers at the same time, the first one wins
+                self.send(worker, encode_msg({ACTION: KICK, ACCOUNT_NAME: name}))
+                return
+            self.owners[name] = worker
+            self.send_others(worker, frame.raw)
+        elif action == REPLACE:
+            name = message[ACCOUNT_NAME]
+            owner = self.owners.get(name)
+            if owner is not None and owner is not worker:
+                self.send(owner, encode_msg({ACTION: KICK, ACCOUNT_NAME: name}))
+            self.owners[name] = worker
+            self.send_others(worker, encode_msg({ACTION: ONLINE, ACCOUNT_NAME: name}))
+        elif action == OFFLINE:
+            name = message[ACCOUNT_NAME]
+            if self.owners.get(name) is worker:
+                del self.owners[name]
+                self.send_others(worker, frame.raw)
+        elif action == ROUTE:
+            owner = self.owners.get(message[TO])
+            if owner is not None:
+                self.send(owner, frame.raw)
+        elif action == PUBLISH:
+            self.send_others(worker, frame.raw)
+
+    def send(self, worker, frame):
+        try:
+            worker.sendall(frame)
+        except OSError:
+            self.remove_worker(worker)
+
+    def send_others(self, worker, frame):
+        for other in list(self.workers):
+            if other is not worker:
+                self.send(other, frame)
+
+    def remove_worker(self, worker):
+        if worker not in self.workers:
+            return
+        LOGGER.error(f'Worker {worker} disconnected from the broker.')
+        self.workers.discard(worker)
+        self.selector.unregister(worker)
+        worker.close()
+        for name in [name for name, owner in self.owners.items() if owner is worker]:
+            del self.owners[name]
+            self.send_others(worker, encode_msg({ACTION: OFFLINE, ACCOUNT_NAME: name}))
+
+    def close(self):
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ClusterLink:
+    """Connection of a server process to the broker."""
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.server = None
+        self.lock = threading.Lock()
+        self.remote_names = set()  # Users connected to other workers
+
+    def start(self, server):
+        # Messages of the broker are handled in the event loop of the server
+        self.server = server
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        reader = threading.Thread(target=self.read_broker)
+        reader.daemon = True
+        reader.start()
+
+    def read_broker(self):
+        while True:
+            try:
+                frame = get_frame(self.sock)
+                message = frame.message()
+            except (OSError, IncorrectFrameLengthError, IncorrectDataNotDictError, json.decoder.JSONDecodeError):
+                LOGGER.critical('Connection to the broker lost, the worker is stopped.')
+                self.server.call_in_loop(self.server.stop)
+                return
+            self.server.call_in_loop(self.server.cluster_event, message, frame.payload)
+
+    def send(self, message, payload=b''):
+        with self.lock:
+            self.sock.sendall(encode_msg(message, payload))
+
+    def is_remote(self, name):
+        return name in self.remote_names
+
+    def online(self, name, replace=False):
+        if replace:
+            # The broker moves the user to this worker and kicks the old session
+            self.remote_names.discard(name)
+        self.send({ACTION: REPLACE if replace else ONLINE, ACCOUNT_NAME: name})
+
+    def offline(self, name):
+        self.send({ACTION: OFFLINE, ACCOUNT_NAME: name})
+
+    def route(self, to, frame):
+        # The frame of the client is the payload, it is not decoded on the way
+        self.send({ACTION: ROUTE, TO: to}, frame)
+
+    def publish(self, event, data=None):
+        self.send({ACTION: PUBLISH, EVENT: event, DATA: data})
@@ -1,21 +1,250 @@
 import json
-from common.variables import ENCODING, MAX_PACKAGE_LENGTH
-from common.errors import IncorrectDataNotDictError
-from common.decos import Logging
+import time
+import zlib
+import errno
+import struct
+import weakref
+import threading
+from collections import deque
+from common.variables import ENCODING, MAX_PACKAGE_LENGTH, MAX_FRAME_LENGTH, COMPRESSION_THRESHOLD, TICKET
+from common.errors import IncorrectDataNotDictError, IncorrectFrameLengthError
+from common.decos import log
+from common.codec import JSON, BINARY, pack, unpack
 
+# Each frame on the wire: lengths of the header and of the payload (4 bytes each, network byte order),
+# the header - dictionary with the routing fields, the payload - opaque bytes (ciphertext).
+# The high bit of the header length is set when the header is in the binary codec instead of JSON,
+# so every frame can be decoded whatever codec the connection has negotiated.
+# The next bit marks a compressed frame: its payload is the next piece of the zlib stream
+# of the connection and contains one whole frame.
+FRAME_PREFIX = struct.Struct('!II')
+BINARY_HEADER = 0x80000000
+COMPRESSED = 0x40000000
+HEADER_LENGTH = 0x3fffffff
 
-@Logging()
-def send_msg(socket, msg):
-    json_msg = json.dumps(msg)
-    coding_msg = json_msg.encode(ENCODING)
-    socket.send(coding_msg)
 
+def encode_msg(msg, payload=b'', codec=JSON):
+    """Serialize the dictionary and the payload into one frame."""
+    header = None
+    if codec == BINARY:
+        try:
+            header = pack(msg)
+            flags = BINARY_HEADER
+        except OverflowError:
+            pass  # Integers beyond 64 bits, each frame carries its codec, so this one is sent in JSON
+    if header is None:
+        header = json.dumps(msg).encode(ENCODING)
+        flags = 0
+    if len(header) + len(payload) > MAX_FRAME_LENGTH:
+        raise IncorrectFrameLengthError(len(header) + len(payload))
+    return b''.join((FRAME_PREFIX.pack(len(header) | flags, len(payload)), header, payload))
 
-def get_msg(client):
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
-    json_response = encoded_response.decode(ENCODING)
-    response = json.loads(json_response)
+
+def decode_msg(body, codec=JSON):
+    """Decode the body of one frame, the result must be a dictionary."""
+    if codec == BINARY:
+        return unpack(body)
+    try:
+        response = json.loads(bytes(body).decode(ENCODING))
+    except RecursionError:
+        raise IncorrectDataNotDictError
     if isinstance(response, dict):
         return response
     else:
         raise IncorrectDataNotDictError
+
+
+class Frame:
+    """
+    One received frame. The header and the payload are views of the raw frame,
+    so the frame can be forwarded as it is without copying and serializing.
+    """
+    __slots__ = ('raw', 'header', 'payload', 'codec')
+
+    def __init__(self, raw):
+        self.raw = memoryview(raw)
+        header_length, payload_length = FRAME_PREFIX.unpack_from(raw)
+        self.codec = BINARY if header_length & BINARY_HEADER else JSON
+        header_length &= HEADER_LENGTH
+        self.header = self.raw[FRAME_PREFIX.size:FRAME_PREFIX.size + header_length]
+        self.payload = self.raw[FRAME_PREFIX.size + header_length:]
+
+    def message(self):
+        return decode_msg(self.header, self.codec)
+
+
+class FrameCompressor:
+    """
+    Compression of the frames sent to one connection. All frames are compressed by one
+    zlib stream, so repeated text of previous frames is used as the dictionary.
+    Frames shorter than the threshold are sent as they are.
+    """
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.threshold = threshold
+        self.compressor = zlib.compressobj(level)
+        # Counters of compressed frames
+        self.frames = 0
+        self.raw_size = 0
+        self.compressed_size = 0
+        self.cpu_time = 0.0
+
+    def compress(self, frame):
+        if len(frame) < self.threshold:
+            return frame
+        start = time.thread_time()
+        # Sync flush: the receiver can decompress the frame without waiting for the next ones
+        data = self.compressor.compress(frame) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.cpu_time += time.thread_time() - start
+        self.frames += 1
+        self.raw_size += len(frame)
+        self.compressed_size += len(data)
+        return b''.join((FRAME_PREFIX.pack(COMPRESSED, len(data)), data))
+
+    @property
+    def ratio(self):
+        return self.raw_size / self.compressed_size if self.compressed_size else 1.0
+
+    def __str__(self):
+        return (f'{self.frames} frames compressed, {self.raw_size} -> {self.compressed_size} bytes '
+                f'(ratio {self.ratio:.2f}), {self.cpu_time * 1000:.1f} ms CPU')
+
+
+# Receive buffer of each thread: sockets are read into it, so an idle connection
+# keeps only the tail of its unfinished frame
+_RECEIVE = threading.local()
+
+
+def _receive_buffer():
+    view = getattr(_RECEIVE, 'view', None)
+    if view is None:
+        view = _RECEIVE.view = memoryview(bytearray(MAX_PACKAGE_LENGTH))
+    return view
+
+
+class MessageDecoder:
+    """
+    Incremental decoder of the frame stream of one connection.
+    Received bytes are accumulated in the buffer, complete frames are cut off
+    from its head, the tail of an unfinished frame waits for the next read.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames = deque()  # Complete frames
+        self.decompressor = None  # Created by the first compressed frame
+        self.decompress_time = 0.0
+
+    def read_from(self, sock):
+        """Read available data from the socket, return the number of new complete frames."""
+        view = _receive_buffer()
+        size = sock.recv_into(view)
+        if not size:
+            raise ConnectionResetError(errno.ECONNRESET, 'Connection closed by remote host.')
+        return self.feed(view[:size])
+
+    def feed(self, data):
+        """Add received bytes, return the number of new complete frames."""
+        self.buffer += data
+        count = 0
+        start = 0
+        while len(self.buffer) - start >= FRAME_PREFIX.size:
+            header_length, payload_length = FRAME_PREFIX.unpack_from(self.buffer, start)
+            length = (header_length & HEADER_LENGTH) + payload_length
+            if length > MAX_FRAME_LENGTH:
+                raise IncorrectFrameLengthError(length)
+            end = start + FRAME_PREFIX.size + length
+            if end > len(self.buffer):
+                break
+            if header_length & COMPRESSED:
+                self.frames.append(Frame(self.decompress(self.buffer[start + FRAME_PREFIX.size:end])))
+            else:
+                self.frames.append(Frame(bytes(self.buffer[start:end])))
+            start = end
+            count += 1
+        if start == len(self.buffer):
+            self.buffer = bytearray()  # The memory of the consumed frames is released
+        elif start:
+            del self.buffer[:start]
+        return count
+
+    def decompress(self, data):
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj()
+        start = time.thread_time()
+        try:
+            # The size of the result is limited like the size of any frame
+            frame = self.decompressor.decompress(data, FRAME_PREFIX.size + MAX_FRAME_LENGTH)
+        except zlib.error:
+            raise IncorrectFrameLengthError(len(data))
+        self.decompress_time += time.thread_time() - start
+        if self.decompressor.unconsumed_tail or len(frame) < FRAME_PREFIX.size:
+            raise IncorrectFrameLengthError(len(frame))
+        return frame
+
+    def messages(self):
+        """Decoded headers of all complete frames."""
+        while self.frames:
+            yield self.frames.popleft().message()
+
+
+# Decoders of sockets that are read with get_msg
+_DECODERS = weakref.WeakKeyDictionary()
+# Codecs negotiated for the connections, JSON if not set
+_CODECS = weakref.WeakKeyDictionary()
+# Compressors of the connections that negotiated compression
+_COMPRESSORS = weakref.WeakKeyDictionary()
+
+
+def get_decoder(sock):
+    """Decoder bound to the socket, created on first use."""
+    decoder = _DECODERS.get(sock)
+    if decoder is None:
+        decoder = _DECODERS[sock] = MessageDecoder()
+    return decoder
+
+
+def set_codec(sock, codec):
+    """Codec of the headers sent to the connection."""
+    _CODECS[sock] = codec
+
+
+def get_codec(sock):
+    return _CODECS.get(sock, JSON)
+
+
+def set_compression(sock, threshold=COMPRESSION_THRESHOLD):
+    """Compress the frames sent to the connection from now on."""
+    _COMPRESSORS[sock] = FrameCompressor(threshold)
+
+
+def get_compressor(sock):
+    return _COMPRESSORS.get(sock)
+
+
+def compress_frame(sock, frame):
+    """The frame as it is sent to the connection, in the order of sending."""
+    compressor = _COMPRESSORS.get(sock)
+    return compressor.compress(frame) if compressor else frame
+
+
+def loggable(msg):
+    """The message as it is written to the log, the ticket is hidden: it logs the user in."""
+    if isinstance(msg, dict) and TICKET in msg:
+        msg = dict(msg)
+        msg[TICKET] = '***'
+    return msg
+
+
+def send_msg(socket, msg, payload=b''):
+    log.debug(f'Sending the message {loggable(msg)}.')
+    socket.sendall(compress_frame(socket, encode_msg(msg, payload, get_codec(socket))))
+
+
+def get_frame(client):
+    decoder = get_decoder(client)
+    while not decoder.frames:
+        decoder.read_from(client)
+    return decoder.frames.popleft()
+
+
+def get_msg(client):
+    return get_frame(client).message()
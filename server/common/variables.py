@@ -1,9 +1,20 @@
-MAX_CONNECTIONS = 3
-MAX_PACKAGE_LENGTH = 100000
+MAX_CONNECTIONS = 128  # Queue length of the listening socket
+MAX_PACKAGE_LENGTH = 100000  # Size of one socket read
+MAX_FRAME_LENGTH = 16 * 1024 * 1024  # Maximum size of one message
+MESSAGES_PAGE_LIMIT = 50  # Maximum number of group messages in one answer
 ENCODING = 'utf-8'
 DEFAULT_IP_ADDRESS = '127.0.0.1'
 DEFAULT_PORT = 7777
+# Password hashing (PBKDF2) of users registered without other parameters
+KDF_ALGORITHM = 'sha512'
+KDF_ITERATIONS = 10000
+COMPRESSION_THRESHOLD = 512  # Smaller frames are not compressed, bytes
 CONFIG_FILE_NAME = 'config_server.ini'
+HANDSHAKE_TIMEOUT = 10  # Seconds for the client to pass authorization
+TICKET_LIFETIME = 600  # Seconds a client can log in again with its ticket
+# Limits of the outgoing queue of one client, bytes
+OUTBOUND_HIGH_WATER = 1024 * 1024
+OUTBOUND_LOW_WATER = 256 * 1024
 
 # JIM поля
 ACTION = 'action'
@@ -20,6 +31,12 @@ MESSAGE_TEXT = 'msg_text'
 FROM = 'from'
 TO = 'to'
 IMAGE = 'image'
+KDF = 'kdf'  # [algorithm, iterations] of the password hash
+CODEC = 'codec'  # codecs of the client in PRESENCE, the chosen one in the answer
+COMPRESSION = 'compression'  # compression methods of the client in PRESENCE, the chosen one in the answer
+ZLIB = 'zlib'
+REQUEST_ID = 'id'  # id of the request of the client, repeated in the answer
+TICKET = 'ticket'  # ticket to log in again without the password, given with the answer 200
 EXIT = 'exit'
 
 # значения action
@@ -27,15 +44,28 @@ PRESENCE = 'presence'  # при подключении к серверу кли
 MESSAGE = 'msg'
 GET_CONTACTS = 'get_contacts'
 LIST_INFO = 'data_list'
+USERS_VERSION = 'users_version'  # version of the user directory
+ADDED = 'added'
+REMOVED = 'removed'
+VERSION = 'version'  # last version of the collection known to the client, the current one in the answer
+BEFORE = 'before'  # id of a message, the page of older messages
+AFTER = 'after'  # id of a message, the page of newer messages
+LIMIT = 'limit'  # number of messages in the page
+KEY_ID = 'key_id'  # id of the group key of the sender
 DELETE_CONTACT = 'del_contact'
 ADD_CONTACT = 'add_contact'
 USERS_REQUEST = 'get_users'
 PUBLIC_KEY_REQUEST = 'get_pubkey'
+KEYS_REQUEST = 'get_keys'  # logins whose public keys have been replaced since the version
 SEND_AVATAR = 'send_avatar'
 GET_AVATAR = 'get_avatar'
 GET_GROUPS = 'get_groups'
 GET_MESSAGES_GROUPS = 'get_messages_groups'
 MESSAGE_GROUP = 'message_group'
+SENDER_KEY = 'sender_key'  # group key of the sender wrapped for each member of the group
+GET_SENDER_KEYS = 'get_sender_keys'  # group keys of other members wrapped for the user
+JOIN = 'join'  # присоединиться к чату
+LEAVE = 'leave'  # покинуть чать
 
 # code
 OK = 200
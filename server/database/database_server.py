@@ -1,10 +1,17 @@
-from sqlalchemy import create_engine, Column, String, Integer, ForeignKey, DateTime, Text
+from sqlalchemy import create_engine, Column, String, Integer, ForeignKey, DateTime, Text, Boolean, inspect, \
+    text, func, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import datetime
 
 Base = declarative_base()
 
+# Collections of the client with versioned changes
+USERS = 'users'
+CONTACTS = 'contacts'  # Separate versions for each user
+GROUPS = 'groups'
+KEYS = 'keys'  # Logins whose public key has been replaced
+
 
 class ServerDB:
     """Create tables in database. Interacts with the database of this server"""
@@ -14,14 +21,20 @@ class ServerDB:
         login = Column(String, unique=True)
         fullname = Column(String)
         password_hash = Column(String)
+        # PBKDF2 parameters of the hash, NULL - KDF_ALGORITHM and KDF_ITERATIONS
+        kdf_algorithm = Column(String)
+        kdf_iterations = Column(Integer)
         last_login = Column(DateTime)
         pubkey = Column(Text)
         image = Column(String)
 
-        def __init__(self, login, fullname=None, password_hash=None, pubkey=None, image_path=None):
+        def __init__(self, login, fullname=None, password_hash=None, pubkey=None, image_path=None,
+                     kdf_algorithm=None, kdf_iterations=None):
             self.login = login
             self.fullname = fullname
             self.password_hash = password_hash
+            self.kdf_algorithm = kdf_algorithm
+            self.kdf_iterations = kdf_iterations
             self.last_login = datetime.datetime.now()
             self.pubkey = pubkey
             self.image = image_path
@@ -110,6 +123,8 @@ class ServerDB:
 
     class GroupsMessages(Base):
         __tablename__ = 'groups_messages'
+        # Pages of one group are read by id
+        __table_args__ = (Index('ix_groups_messages_group_id_id', 'group_id', 'id'),)
         id = Column(Integer, primary_key=True)
         group_id = Column(ForeignKey('groups.group_id'))
         from_user = Column(String)
@@ -126,6 +141,66 @@ class ServerDB:
             return "<Group messages('%s','%s, '%s','%s)>" % \
                    (self.group_id, self.from_user, self.message, self.date)
 
+    class GroupsMembers(Base):
+        __tablename__ = 'groups_members'
+        __table_args__ = (UniqueConstraint('group_id', 'user_id'),)
+        id = Column(Integer, primary_key=True)
+        group_id = Column(ForeignKey('groups.group_id'))
+        user_id = Column(ForeignKey('users_all.id'), index=True)
+
+        def __init__(self, group_id, user_id):
+            self.group_id = group_id
+            self.user_id = user_id
+
+        def __repr__(self):
+            return "<Group member('%s','%s')>" % \
+                   (self.group_id, self.user_id)
+
+    class SenderKeys(Base):
+        # Group key of the sender wrapped with the public key of each member, the server cannot read it
+        __tablename__ = 'sender_keys'
+        __table_args__ = (Index('ix_sender_keys_group_id_recipient', 'group_id', 'recipient'),
+                          Index('ix_sender_keys_group_id_sender_key_id', 'group_id', 'sender', 'key_id'))
+        id = Column(Integer, primary_key=True)
+        group_id = Column(ForeignKey('groups.group_id'))
+        sender = Column(String)
+        recipient = Column(String)
+        key_id = Column(Integer)
+        wrapped_key = Column(Text)
+
+        def __init__(self, group_id, sender, recipient, key_id, wrapped_key):
+            self.group_id = group_id
+            self.sender = sender
+            self.recipient = recipient
+            self.key_id = key_id
+            self.wrapped_key = wrapped_key
+
+        def __repr__(self):
+            return "<Sender key('%s','%s', '%s', '%s')>" % \
+                   (self.group_id, self.sender, self.recipient, self.key_id)
+
+    class Changes(Base):
+        # Added and removed items of the collections, the version of a collection grows by one with each change
+        __tablename__ = 'changes'
+        __table_args__ = (Index('ix_changes_collection_version', 'collection', 'owner', 'version'),)
+        id = Column(Integer, primary_key=True)
+        collection = Column(String)
+        owner = Column(String)  # Login of the user for personal collections
+        version = Column(Integer)
+        item = Column(String)
+        deleted = Column(Boolean)
+
+        def __init__(self, collection, owner, version, item, deleted):
+            self.collection = collection
+            self.owner = owner
+            self.version = version
+            self.item = item
+            self.deleted = deleted
+
+        def __repr__(self):
+            return "<Change('%s','%s', '%s', '%s', '%s')>" % \
+                   (self.collection, self.owner, self.version, self.item, self.deleted)
+
     def __init__(self, path):
         # echo=False - disable logging (output sql queries)
         # pool_recycle - By default, the connection to the database is terminated after 8 hours of inactivity.
@@ -134,6 +209,7 @@ class ServerDB:
                                              connect_args={'check_same_thread': False})
 
         Base.metadata.create_all(self.database_engine)
+        self.add_missing_columns()
 
         Session = sessionmaker(bind=self.database_engine)
         self.session = Session()
@@ -142,12 +218,54 @@ class ServerDB:
         self.session.query(self.ActiveUsers).delete()
         self.session.commit()
 
+    def add_missing_columns(self):
+        # create_all does not change existing tables, add the columns and indexes of newer versions
+        columns = [column['name'] for column in inspect(self.database_engine).get_columns('users_all')]
+        with self.database_engine.begin() as connection:
+            connection.execute(text('CREATE INDEX IF NOT EXISTS ix_groups_messages_group_id_id '
+                                    'ON groups_messages (group_id, id)'))
+            if 'kdf_algorithm' not in columns:
+                connection.execute(text('ALTER TABLE users_all ADD COLUMN kdf_algorithm VARCHAR'))
+            if 'kdf_iterations' not in columns:
+                connection.execute(text('ALTER TABLE users_all ADD COLUMN kdf_iterations INTEGER'))
+
+    def get_version(self, collection, owner=None):
+        version = self.session.query(func.max(self.Changes.version)).\
+            filter_by(collection=collection, owner=owner).scalar()
+        return version or 0
+
+    def add_changes(self, collection, items, deleted=False, owner=None):
+        # One new version for all items, committed together with the change itself
+        version = self.get_version(collection, owner) + 1
+        self.session.add_all([self.Changes(collection, owner, version, item, deleted) for item in items])
+        return version
+
+    def get_changes(self, collection, since, owner=None):
+        """
+        Version of the collection and (added, removed) after the version since,
+        None instead of changes if the client has to load the whole collection.
+        """
+        version = self.get_version(collection, owner)
+        if not since or since > version:
+            return version, None
+        changes = self.session.query(self.Changes.item, self.Changes.deleted).\
+            filter_by(collection=collection, owner=owner).\
+            filter(self.Changes.version > since).order_by(self.Changes.version)
+        deleted = dict(changes.all())  # The last change of each item
+        return version, ([item for item, is_deleted in deleted.items() if not is_deleted],
+                         [item for item, is_deleted in deleted.items() if is_deleted])
+
     def login_user(self, login, ip_address, port, key):
+        # Returns the new version of keys if the public key of the user has been replaced
+        key_version = None
         user = self.session.query(self.AllUsers).filter_by(login=login)
         if user.count():
             user = user.first()
             user.last_login = datetime.datetime.now()
             if user.pubkey != key:
+                # Clients drop the old key of the user from their caches
+                if user.pubkey:
+                    key_version = self.add_changes(KEYS, [login])
                 user.pubkey = key
         else:
             raise ValueError('Пользователь не зарегистрирован.')
@@ -160,6 +278,7 @@ class ServerDB:
         new_history = self.HistoryLogin(user.id, now_time, ip_address, port)
         self.session.add(new_history)
         self.session.commit()
+        return key_version
 
     def is_user(self, login):
         if self.session.query(self.AllUsers).filter_by(login=login).count():
@@ -167,14 +286,29 @@ class ServerDB:
         else:
             return False
 
-    def add_user(self, login, password_hash, fullname=None):
-        user = self.AllUsers(login, fullname, password_hash)
+    def add_user(self, login, password_hash, fullname=None, kdf_algorithm=None, kdf_iterations=None):
+        user = self.AllUsers(login, fullname, password_hash,
+                             kdf_algorithm=kdf_algorithm, kdf_iterations=kdf_iterations)
         self.session.add(user)
         self.session.commit()
 
         add_in_history = self.UsersHistory(user.id)
         self.session.add(add_in_history)
+        version = self.add_changes(USERS, [login])
+        self.session.commit()
+        return version
+
+    def add_users(self, users, kdf_algorithm=None, kdf_iterations=None):
+        # Register many users (login, password_hash, fullname) in one transaction
+        new_users = [self.AllUsers(login, fullname, password_hash,
+                                   kdf_algorithm=kdf_algorithm, kdf_iterations=kdf_iterations)
+                     for login, password_hash, fullname in users]
+        self.session.add_all(new_users)
+        self.session.flush()
+        self.session.add_all([self.UsersHistory(user.id) for user in new_users])
+        version = self.add_changes(USERS, [user.login for user in new_users])
         self.session.commit()
+        return version
 
     def remove_user(self, login):
         user = self.session.query(self.AllUsers).filter_by(login=login).first()
@@ -182,16 +316,32 @@ class ServerDB:
         self.session.query(self.HistoryLogin).filter_by(user_id=user.id).delete()
         self.session.query(self.ContactsUsers).filter_by(user_id=user.id).delete()
         self.session.query(self.UsersHistory).filter_by(user_id=user.id).delete()
+        self.session.query(self.GroupsMembers).filter_by(user_id=user.id).delete()
         self.session.query(self.AllUsers).filter_by(login=login).delete()
+        version = self.add_changes(USERS, [login], deleted=True)
         self.session.commit()
+        return version
 
     def get_hash(self, login):
         user = self.session.query(self.AllUsers).filter_by(login=login).first()
-        return user.password_hash
+        return user.password_hash if user else None
+
+    def get_password(self, login):
+        # Password hash with its PBKDF2 parameters, None for an unknown user
+        user = self.session.query(self.AllUsers).filter_by(login=login).first()
+        if not user:
+            return None
+        return user.password_hash, user.kdf_algorithm, user.kdf_iterations
 
     def get_pubkey(self, login):
         user = self.session.query(self.AllUsers).filter_by(login=login).first()
-        return user.pubkey
+        return user.pubkey if user else None
+
+    def get_pubkeys(self, logins):
+        # {login: public key} of the users that have keys
+        query = self.session.query(self.AllUsers.login, self.AllUsers.pubkey).\
+            filter(self.AllUsers.login.in_(logins), self.AllUsers.pubkey.isnot(None))
+        return dict(query.all())
 
     def user_logout(self, login):
         user = self.session.query(self.AllUsers).filter_by(login=login).first()
@@ -207,6 +357,7 @@ class ServerDB:
 
         new_contact = self.ContactsUsers(user_id=user.id, contact=contact.id)
         self.session.add(new_contact)
+        self.add_changes(CONTACTS, [contact.login], owner=user.login)
         self.session.commit()
 
     def delete_contact(self, user, contact):
@@ -216,8 +367,8 @@ class ServerDB:
         if not contact:
             return
 
-        self.session.query(self.ContactsUsers).filter_by(user_id=user.id,
-                                                         contact=contact.id).delete()
+        if self.session.query(self.ContactsUsers).filter_by(user_id=user.id, contact=contact.id).delete():
+            self.add_changes(CONTACTS, [contact.login], deleted=True, owner=user.login)
         self.session.commit()
 
     def sending_message(self, sender, receiver):
@@ -237,6 +388,24 @@ class ServerDB:
         contacts = [contact[1] for contact in contacts.all()]
         return contacts
 
+    def get_users_changes(self, since=None):
+        # (version, changes, all logins if there are no changes)
+        version, changes = self.get_changes(USERS, since)
+        return version, changes, None if changes else [user[0] for user in self.users_all()]
+
+    def get_contacts_changes(self, login_user, since=None):
+        version, changes = self.get_changes(CONTACTS, since, login_user)
+        return version, changes, None if changes else self.get_contacts(login_user)
+
+    def get_keys_changes(self, since=None):
+        # Without a version the client drops all saved keys, the list is empty
+        version, changes = self.get_changes(KEYS, since)
+        return version, changes, None if changes else []
+
+    def get_groups_changes(self, since=None):
+        version, changes = self.get_changes(GROUPS, since)
+        return version, changes, None if changes else [group[1] for group in self.get_groups()]
+
     def users_active_list(self):
         users = self.session.query(
             self.AllUsers.login,
@@ -282,20 +451,121 @@ class ServerDB:
     def add_new_group(self, group_name):
         group = self.Groups(group_name)
         self.session.add(group)
+        self.add_changes(GROUPS, [group_name])
         self.session.commit()
 
     def get_groups(self):
         groups = self.session.query(self.Groups.group_id, self.Groups.group_name)
         return groups.all()
 
-    def add_group_message(self, group_name, from_user, message):
+    def join_group(self, group_name, login):
+        # False if there is no such group or user
+        group = self.session.query(self.Groups).filter_by(group_name=group_name).first()
+        user = self.session.query(self.AllUsers).filter_by(login=login).first()
+        if not group or not user:
+            return False
+        if not self.session.query(self.GroupsMembers).filter_by(group_id=group.group_id, user_id=user.id).count():
+            self.session.add(self.GroupsMembers(group.group_id, user.id))
+            self.session.commit()
+        return True
+
+    def leave_group(self, group_name, login):
+        group = self.session.query(self.Groups).filter_by(group_name=group_name).first()
+        user = self.session.query(self.AllUsers).filter_by(login=login).first()
+        if not group or not user:
+            return False
+        self.session.query(self.GroupsMembers).filter_by(group_id=group.group_id, user_id=user.id).delete()
+        self.session.commit()
+        return True
+
+    def get_user_groups(self, login):
+        groups = self.session.query(self.Groups.group_name).\
+            join(self.GroupsMembers, self.GroupsMembers.group_id == self.Groups.group_id).\
+            join(self.AllUsers, self.GroupsMembers.user_id == self.AllUsers.id).\
+            filter(self.AllUsers.login == login)
+        return [group[0] for group in groups.all()]
+
+    def get_group_members(self, group_id):
+        members = self.session.query(self.AllUsers.login).\
+            join(self.GroupsMembers, self.GroupsMembers.user_id == self.AllUsers.id).\
+            filter(self.GroupsMembers.group_id == group_id)
+        return sorted(member[0] for member in members.all())
+
+    def add_sender_keys(self, group_name, sender, key_id, wrapped_keys):
+        """
+        Save the group key of the sender wrapped for each member {login: wrapped key}.
+        The key is saved only if it is given to exactly the members of the group,
+        returns the members, None if there is no such group.
+        """
+        group = self.session.query(self.Groups).filter_by(group_name=group_name).first()
+        if not group:
+            return None
+        members = self.get_group_members(group.group_id)
+        if sorted(wrapped_keys) == members:
+            self.session.add_all([self.SenderKeys(group.group_id, sender, recipient, key_id, wrapped_key)
+                                  for recipient, wrapped_key in wrapped_keys.items()])
+            self.session.commit()
+        return members
+
+    def get_sender_keys(self, group_name, recipient):
+        # (sender, key id, wrapped key) of the keys given to the user in the group
+        keys = self.session.query(self.SenderKeys.sender, self.SenderKeys.key_id, self.SenderKeys.wrapped_key).\
+            join(self.Groups, self.SenderKeys.group_id == self.Groups.group_id).\
+            filter(self.Groups.group_name == group_name, self.SenderKeys.recipient == recipient).\
+            order_by(self.SenderKeys.id)
+        return [tuple(key) for key in keys.all()]
+
+    def add_group_message(self, group_name, from_user, message, key_id=None):
+        """
+        Save the message, returns (id of the message, None). A message encrypted with the key
+        key_id of the sender is not saved if the key was not given to exactly the members
+        of the group, (None, members) is returned then and the sender makes a new key.
+        """
         group_id = self.session.query(self.Groups).filter_by(group_name=group_name).first().group_id
+        if key_id is not None:
+            members = self.get_group_members(group_id)
+            recipients = self.session.query(self.SenderKeys.recipient).\
+                filter_by(group_id=group_id, sender=from_user, key_id=key_id)
+            if sorted(recipient[0] for recipient in recipients.all()) != members:
+                return None, members
         new_message = self.GroupsMessages(group_id, from_user, message, date=datetime.datetime.now())
         self.session.add(new_message)
         self.session.commit()
-
-    def get_messages_groups(self):
-        query = self.session.query(self.GroupsMessages)
-        return [(history_row.group_id, history_row.from_user, history_row.message,
-                 history_row.date.strftime('%y-%m-%d %H:%M:%S'))
-                for history_row in query.all()]
+        return new_message.id, None  # The id is the version of group messages
+
+    def _messages_rows(self):
+        # Plain rows (id, group name, from user, message, date) without ORM objects
+        return self.session.query(self.GroupsMessages.id, self.Groups.group_name, self.GroupsMessages.from_user,
+                                  self.GroupsMessages.message, self.GroupsMessages.date).\
+            join(self.Groups, self.GroupsMessages.group_id == self.Groups.group_id)
+
+    @staticmethod
+    def _format_messages(rows):
+        return [(message_id, group_name, from_user, message, date.strftime('%y-%m-%d %H:%M:%S'))
+                for message_id, group_name, from_user, message, date in rows]
+
+    def get_messages_groups(self, since, limit):
+        """
+        Version and at most limit messages after the message with the id since.
+        Without since only the id of the last message is returned,
+        the history of a group is read by pages.
+        """
+        if not since:
+            return self.session.query(func.max(self.GroupsMessages.id)).scalar() or 0, []
+        rows = self._messages_rows().filter(self.GroupsMessages.id > since).\
+            order_by(self.GroupsMessages.id).limit(limit).all()
+        return rows[-1][0] if rows else since, self._format_messages(rows)
+
+    def get_messages_group_page(self, group_name, limit, before=None, after=None):
+        """
+        Page of the group history in the order of ids: the last messages,
+        the messages before the id before or the first messages after the id after.
+        """
+        query = self._messages_rows().filter(self.Groups.group_name == group_name)
+        if after:
+            rows = query.filter(self.GroupsMessages.id > after).order_by(self.GroupsMessages.id).limit(limit).all()
+        else:
+            if before:
+                query = query.filter(self.GroupsMessages.id < before)
+            rows = query.order_by(self.GroupsMessages.id.desc()).limit(limit).all()[::-1]
+        return self._format_messages(rows)
@@ -1,8 +1,9 @@
 import sys
+import csv
 from PyQt5 import QtGui
 from PyQt5.QtCore import pyqtSlot
 from PyQt5.QtWidgets import QWidget, QApplication, QTableView, QMainWindow, \
-    QAction, QLabel, QGridLayout, QMenu
+    QAction, QLabel, QGridLayout, QMenu, QFileDialog, QMessageBox
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from gui_server.gui_settings_window import SettingsWindow
 from gui_server.gui_registration_user import RegistrationDialog
@@ -43,10 +44,14 @@ class MainWindow(QMainWindow):
         rm_user = QAction('Remove user', self)
         rm_user.triggered.connect(self.user_remove)
 
+        import_users = QAction('Import users', self)
+        import_users.triggered.connect(self.users_import)
+
         menu_users = QMenu('Users', self)
         menu_users.setObjectName("menu_users")
         menu_users.addAction(add_user)
         menu_users.addAction(rm_user)
+        menu_users.addAction(import_users)
 
         create_group = QAction('Create group', self)
         create_group.triggered.connect(self.create_group)
@@ -95,6 +100,22 @@ class MainWindow(QMainWindow):
         self.del_user_window = RemoveUserDialog(self.database, self.server)
         self.del_user_window.init_ui()
         
+    def users_import(self):
+        """Register users from a CSV file with rows: login, password, full name."""
+        file_path, _ = QFileDialog.getOpenFileName(self, 'Import users', '', 'CSV (*.csv)')
+        if not file_path:
+            return
+        accounts = dict()
+        with open(file_path, encoding='utf-8', newline='') as file:
+            for row in csv.reader(file):
+                if len(row) >= 2 and row[0] and row[1] and not self.server.run_db_method(self.database.is_user, row[0]):
+                    accounts[row[0]] = (row[0], row[1], row[2] if len(row) > 2 else None)
+        accounts = list(accounts.values())
+        if accounts and self.server.add_new_users(accounts):
+            QMessageBox.information(self, 'Success', f'Registered users: {len(accounts)}.')
+        else:
+            QMessageBox.information(self, 'Warning', 'No new users in the file.')
+
     def settings_window_open(self):
         self.settings_window = SettingsWindow(self.parser)
         self.settings_window.init_ui()
@@ -111,7 +132,7 @@ class MainWindow(QMainWindow):
         self.connected_users_list.appendRow([user_name, ip_address, port, connection_time])
 
     def update_connected_users_list(self):
-        users = self.database.users_active_list()
+        users = self.server.run_db_method(self.database.users_active_list)
         self.connected_users_list.clear()
         self.connected_users_list.setHorizontalHeaderLabels(['Name', 'IP', 'Port', 'Connection time'])
 
@@ -33,7 +33,7 @@ class RegistrationDialog(QDialog):
             if password != confirm_password:
                 self.message_window.critical(self, 'Error', 'The entered passwords do not match.')
                 return
-            elif self.database.is_user(login_user):
+            elif self.server.run_db_method(self.database.is_user, login_user):
                 self.message_window.critical(self, 'Error', 'User already exists.')
                 return
             else:
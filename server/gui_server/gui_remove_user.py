@@ -41,7 +41,7 @@ class RemoveUserDialog(QDialog):
             self.del_user_window.user_interface.removeButton.clicked.connect(self.update_users_all)
 
     def update_users_all(self):
-        users_all = self.database_server.users_all()
+        users_all = self.server_transport.run_db_method(self.database_server.users_all)
         self.users_all_model.clear()
         self.users_all_model.setHorizontalHeaderLabels(['Login', 'Fullname', 'Last login'])
 